@@ -0,0 +1 @@
+The `versions` file of a publication is appended to the one of the previous publication unless `compact_versions` is requested.
@@ -0,0 +1 @@
+Info files are published in batches with bulk inserts and parallel uploads, instead of one transaction per file.
@@ -0,0 +1 @@
+The compact index files are served with a strong `ETag` and `Repr-Digest` and `Digest` headers, and conditional requests for them are answered with 304 Not Modified.
@@ -0,0 +1 @@
+Compile the remote's include and exclude filters once per sync instead of parsing them for every version.
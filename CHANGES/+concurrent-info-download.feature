@@ -0,0 +1 @@
+Info files are now downloaded concurrently during sync, bounded by the remote's `download_concurrency`.
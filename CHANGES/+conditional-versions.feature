@@ -0,0 +1 @@
+Syncs finish without creating a new repository version if the remote's `versions` file did not change since the last sync.
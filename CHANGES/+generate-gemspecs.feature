@@ -0,0 +1 @@
+Added the `generate_gemspecs` option to remotes, to generate the gemspecs from the gem files instead of downloading them.
@@ -0,0 +1 @@
+Added the `gzip_compact_index` option to publications, to publish gzip compressed variants of the compact index files and serve them with `Content-Encoding: gzip`.
@@ -0,0 +1 @@
+Publishing hashes the info files while writing them instead of reading them back from the storage to compute their md5 sums.
@@ -0,0 +1 @@
+Added the `html_index` and `html_index_page_size` options to publications, to skip or paginate the generated html index pages.
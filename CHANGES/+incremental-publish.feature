@@ -0,0 +1 @@
+Publications reuse the info files of gems that did not change since the previous publication of the repository.
@@ -0,0 +1 @@
+Re-syncs only download the part of the remote's `versions` file that was appended since the last sync.
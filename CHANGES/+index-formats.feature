@@ -0,0 +1 @@
+Added the `index_formats` option to publications, to publish only the compact index or only the legacy specs files.
@@ -0,0 +1 @@
+Generate the compact index info files from a single database query instead of one query per gem.
@@ -0,0 +1 @@
+Gemspecs of on-demand gems are now generated from the stored gem file and saved on their first request, instead of being fetched from the remote.
@@ -0,0 +1 @@
+Gem metadata is now parsed with the LibYAML based loader when it is available, falling back to the pure Python loader otherwise.
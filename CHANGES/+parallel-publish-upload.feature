@@ -0,0 +1 @@
+Generated publication files are uploaded to the storage in parallel, using up to `GEM_PUBLISH_UPLOAD_WORKERS` threads.
@@ -0,0 +1 @@
+Re-syncs skip the info files of gems that did not change since the last sync of the repository.
@@ -0,0 +1 @@
+The gzip compressed specs files are written together with the plain ones in a single pass. Their compression level can be set with `GEM_PUBLISH_GZIP_LEVEL`.
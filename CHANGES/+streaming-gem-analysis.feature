@@ -0,0 +1 @@
+Gem files are now analysed by reading their tar headers in order and stopping after `metadata.gz`, instead of scanning the member headers of the whole gem.
@@ -0,0 +1 @@
+The specs files are streamed from the database with a dedicated Marshal writer, keeping the memory use of a publish flat. This also fixes the encoding of the Gem::Version objects in them.
@@ -0,0 +1 @@
+Parse the `versions` file in a streaming fashion instead of collecting all gems in memory first.
@@ -0,0 +1 @@
+Added a database sortable version key to gems and compute the latest versions of a publication in the database.
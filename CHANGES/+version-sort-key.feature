@@ -0,0 +1 @@
+Compare gem versions through cached sort keys that follow the ordering of RubyGems.
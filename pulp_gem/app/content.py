@@ -0,0 +1,51 @@
+from aiohttp import web
+
+from pulpcore.plugin.content import app
+
+from pulp_gem.app.models import current_request
+
+
+def _etag_matches(if_none_match, etag):
+    """Whether an If-None-Match header matches the ETag, comparing weakly as RFC 9110 asks."""
+    if if_none_match is None or etag is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+
+# pulpcore has no per plugin hook into the content app, and `content_handler` is not given the
+# request. So this middleware is added to the whole content app, and it has to leave the requests
+# of the other plugins alone: it only remembers the request, and it only answers conditional
+# requests for the responses carrying a Repr-Digest header, that only `GemDistribution` sets.
+@web.middleware
+async def gem_content_middleware(request, handler):
+    """
+    Make the request available to `GemDistribution.content_handler`, and answer conditional
+    requests for the compact index files with 304 Not Modified.
+
+    The conditional requests are answered here, outside of the content cache, so they work
+    whether it is enabled or not.
+    """
+    token = current_request.set(request)
+    try:
+        response = await handler(request)
+    finally:
+        current_request.reset(token)
+    if (
+        request.method in ("GET", "HEAD")
+        and response.status == 200
+        and not response.prepared
+        and "Repr-Digest" in response.headers
+        and _etag_matches(request.headers.get("If-None-Match"), response.headers.get("ETag"))
+    ):
+        headers = {
+            key: response.headers[key]
+            for key in ("ETag", "Repr-Digest", "Digest", "Vary", "Content-Encoding")
+            if key in response.headers
+        }
+        return web.Response(status=304, headers=headers)
+    return response
+
+
+app.middlewares.append(gem_content_middleware)
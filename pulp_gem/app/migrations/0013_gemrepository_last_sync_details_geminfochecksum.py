@@ -0,0 +1,50 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:38
+
+import django.db.models.deletion
+import django_lifecycle.mixins
+import pulpcore.app.models.base
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("gem", "0012_alter_gemdistribution_options_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="gemrepository",
+            name="last_sync_details",
+            field=models.JSONField(default=dict),
+        ),
+        migrations.CreateModel(
+            name="GemInfoChecksum",
+            fields=[
+                (
+                    "pulp_id",
+                    models.UUIDField(
+                        default=pulpcore.app.models.base.pulp_uuid,
+                        editable=False,
+                        primary_key=True,
+                        serialize=False,
+                    ),
+                ),
+                ("pulp_created", models.DateTimeField(auto_now_add=True)),
+                ("pulp_last_updated", models.DateTimeField(auto_now=True, null=True)),
+                ("name", models.TextField()),
+                ("md5", models.TextField()),
+                (
+                    "repository",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="gem.gemrepository"
+                    ),
+                ),
+            ],
+            options={
+                "default_related_name": "%(app_label)s_%(model_name)s",
+                "unique_together": {("repository", "name")},
+            },
+            bases=(django_lifecycle.mixins.LifecycleModelMixin, models.Model),
+        ),
+    ]
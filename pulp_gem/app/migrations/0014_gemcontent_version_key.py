@@ -0,0 +1,89 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:46
+
+import re
+
+from django.db import migrations, models
+
+# A frozen copy of `pulp_gem.specs.ruby_ver_db_key`, so this migration keeps computing the keys
+# it was written for whatever becomes of the live function.
+VERSION_SEGMENT_REGEX = re.compile(r"[0-9]+|[a-z]+", re.IGNORECASE)
+
+
+def ruby_ver_key(version):
+    segments = [
+        int(segment) if segment.isdigit() else segment
+        for segment in VERSION_SEGMENT_REGEX.findall(version)
+    ]
+    string_start = next(
+        (i for i, segment in enumerate(segments) if isinstance(segment, str)), len(segments)
+    )
+    key = []
+    for part in (segments[:string_start], segments[string_start:]):
+        while part and part[-1] == 0:
+            part.pop()
+        zeros = 0
+        for segment in part:
+            if segment == 0:
+                zeros += 1
+            elif isinstance(segment, str):
+                key.append((-1, zeros, segment))
+                zeros = 0
+            else:
+                key.append((1, -zeros, segment))
+                zeros = 0
+    key.append((0,))
+    return tuple(key)
+
+
+def ruby_ver_db_key(version):
+    parts = []
+    for part in ruby_ver_key(version):
+        if part[0] < 0:
+            parts.append(f"1{min(part[1], 99):02d}{part[2]}!")
+        elif part[0] > 0:
+            digits = str(part[2])
+            parts.append(f"3{99 + max(part[1], -99):02d}{min(len(digits), 99):02d}{digits}")
+        else:
+            parts.append("2")
+    return "".join(parts)
+
+
+def populate_version_key(apps, schema_editor):
+    GemContent = apps.get_model("gem", "GemContent")
+    batch = []
+    for content in GemContent.objects.only("pk", "version").iterator(chunk_size=1000):
+        content.version_key = ruby_ver_db_key(content.version)
+        batch.append(content)
+        if len(batch) >= 1000:
+            GemContent.objects.bulk_update(batch, ["version_key"])
+            batch = []
+    GemContent.objects.bulk_update(batch, ["version_key"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("gem", "0013_gemrepository_last_sync_details_geminfochecksum"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="gemcontent",
+            name="version_key",
+            field=models.TextField(db_collation="C", null=True),
+        ),
+        migrations.RunPython(
+            code=populate_version_key, reverse_code=migrations.RunPython.noop, elidable=True
+        ),
+        migrations.AlterField(
+            model_name="gemcontent",
+            name="version_key",
+            field=models.TextField(db_collation="C"),
+        ),
+        migrations.AddIndex(
+            model_name="gemcontent",
+            index=models.Index(
+                fields=["name", "platform", "version_key"], name="gem_gemcont_name_e7af44_idx"
+            ),
+        ),
+    ]
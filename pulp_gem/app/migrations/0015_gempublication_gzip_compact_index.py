@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("gem", "0014_gemcontent_version_key"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="gempublication",
+            name="gzip_compact_index",
+            field=models.BooleanField(default=False),
+        ),
+    ]
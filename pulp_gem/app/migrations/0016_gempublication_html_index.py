@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("gem", "0015_gempublication_gzip_compact_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="gempublication",
+            name="html_index",
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name="gempublication",
+            name="html_index_page_size",
+            field=models.PositiveIntegerField(null=True),
+        ),
+    ]
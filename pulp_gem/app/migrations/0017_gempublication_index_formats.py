@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("gem", "0016_gempublication_html_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="gempublication",
+            name="index_formats",
+            field=models.TextField(
+                choices=[
+                    ("compact_index", "Compact index"),
+                    ("specs", "Legacy specs"),
+                    ("both", "Both"),
+                ],
+                default="both",
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("gem", "0017_gempublication_index_formats"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="gemremote",
+            name="generate_gemspecs",
+            field=models.BooleanField(default=False),
+        ),
+    ]
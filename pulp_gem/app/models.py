@@ -1,24 +1,229 @@
+import base64
+import hashlib
+import os
+import tempfile
+from contextvars import ContextVar
+from datetime import timedelta
 from logging import getLogger
 from pathlib import PurePath
-from tempfile import NamedTemporaryFile
 
+from aiohttp import ClientError, web
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.postgres.fields import HStoreField
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.utils import timezone
 
+from pulpcore.plugin.exceptions import (
+    DigestValidationError,
+    SizeValidationError,
+    TimeoutException,
+)
 from pulpcore.plugin.models import (
+    Artifact,
     AutoAddObjPermsMixin,
+    BaseModel,
     Content,
+    ContentArtifact,
     Distribution,
     Publication,
+    PublishedArtifact,
     Remote,
+    RemoteArtifact,
     Repository,
 )
-from pulpcore.plugin.util import get_domain_pk
+from pulpcore.plugin.responses import ArtifactResponse
+from pulpcore.plugin.util import get_domain, get_domain_pk
 
 from pulp_gem.specs import analyse_gem
 
 log = getLogger(__name__)
 
+# The request being served by the content app, set by `pulp_gem.app.content`.
+current_request = ContextVar("current_request", default=None)
+
+# The gemspecs of the gems are served under this prefix.
+GEMSPECS_PREFIX = "quick/Marshal.4.8/"
+
+# Publications can carry gzip compressed variants of the compact index files under this prefix.
+GZIP_VARIANTS_PREFIX = "gzip/"
+
+
+def is_compact_index_path(path):
+    """Whether the path is a compact index file, that can have a gzip compressed variant."""
+    return path in ("names", "versions") or path.startswith("info/")
+
+
+# The storage class of domains that store the artifacts on the filesystem of the content app.
+FILESYSTEM_STORAGE = "pulpcore.app.models.storage.FileSystem"
+
+
+def _accepts_gzip(request):
+    """Whether the client accepts gzip content coding for the full file."""
+    if request is None or "Range" in request.headers:
+        return False
+    for coding in request.headers.get("Accept-Encoding", "").split(","):
+        coding, *params = coding.split(";")
+        if coding.strip().lower() not in ("gzip", "x-gzip"):
+            continue
+        for param in params:
+            key, _sep, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def _artifact_from_data(raw_data):
+    sha256 = hashlib.sha256(raw_data).hexdigest()
+    artifact = Artifact.objects.filter(sha256=sha256, pulp_domain=get_domain_pk()).first()
+    if artifact:
+        return artifact
+
+    with tempfile.NamedTemporaryFile("wb", dir=".", delete=False) as tmpfile:
+        tmpfile.write(raw_data)
+
+    artifact = Artifact.init_and_validate(tmpfile.name, expected_digests={"sha256": sha256})
+    artifact.save()
+    return artifact
+
+
+def _read_spec_data(gem_file_path):
+    """Return the Marshal encoded gemspec of a gem file."""
+    with open(gem_file_path, "rb") as gem_file:
+        return analyse_gem(gem_file)[1]
+
+
+def _is_streamed(content_artifact):
+    """Whether the content artifact is provided by a remote with the `streamed` policy."""
+    return RemoteArtifact.objects.filter(
+        content_artifact=content_artifact, remote__policy=Remote.STREAMED
+    ).exists()
+
+
+def _save_gemspec(gem_content_artifact, spec_content_artifact, path, spec_data):
+    """
+    Store a generated gemspec, unless a concurrent request did already.
+
+    If the gem has no content artifact for its gemspec yet, one is added to the content unit,
+    which changes the unit in every repository version that holds it. That is safe: the gemspec
+    is derived from the gem file, whose checksum identifies the unit, so every repository version
+    would serve the same gemspec anyway, and the content of the repository versions is unchanged.
+    """
+    try:
+        with transaction.atomic():
+            artifact = _artifact_from_data(spec_data)
+            if spec_content_artifact is None:
+                ContentArtifact.objects.create(
+                    content_id=gem_content_artifact.content_id,
+                    relative_path=path,
+                    artifact=artifact,
+                )
+            else:
+                spec_content_artifact.artifact = artifact
+                spec_content_artifact.save()
+    except IntegrityError:
+        log.debug("The gemspec %s was stored concurrently.", path)
+
+
+def _generate_gemspec(path, gem_content_artifact, spec_content_artifact):
+    """
+    Generate a gemspec from the stored gem file.
+
+    The gemspec is stored as well, unless it is provided by a `streamed` remote.
+    """
+    spec_data = analyse_gem(gem_content_artifact.artifact.file)[1]
+    if not _is_streamed(spec_content_artifact or gem_content_artifact):
+        _save_gemspec(gem_content_artifact, spec_content_artifact, path, spec_data)
+    return spec_data
+
+
+def _generate_downloaded_gemspec(path, gem_content_artifact, remote, download_result):
+    """
+    Generate a gemspec from a downloaded gem file.
+
+    Like the content app does for the content it streams, the gem file is stored as the artifact
+    of the gem, and the gemspec along with it, unless the remote has the `streamed` policy.
+    """
+    try:
+        spec_data = _read_spec_data(download_result.path)
+        if remote.policy != Remote.STREAMED:
+            artifact = Artifact(**download_result.artifact_attributes, file=download_result.path)
+            try:
+                with transaction.atomic():
+                    artifact.save()
+            except IntegrityError:
+                artifact = Artifact.objects.get(artifact.q())
+                artifact.touch()
+            gem_content_artifact.artifact = artifact
+            gem_content_artifact.save()
+            _save_gemspec(gem_content_artifact, None, path, spec_data)
+    finally:
+        # Saving the artifact moves the file into the storage, unless it was stored already.
+        if os.path.exists(download_result.path):
+            os.remove(download_result.path)
+    return spec_data
+
+
+class _GeneratedGemspecResponse(web.StreamResponse):
+    """
+    A response serving a gemspec generated from the gem file.
+
+    The gem file is read, or downloaded first if it is not stored, when the response is prepared.
+    The content app runs `content_handler` in the thread it shares for the database access of all
+    requests, so the storage and the remote are not accessed from there.
+    """
+
+    def __init__(
+        self,
+        path,
+        gem_content_artifact,
+        spec_content_artifact=None,
+        remote=None,
+        remote_artifact=None,
+    ):
+        super().__init__()
+        self._path = path
+        self._gem_content_artifact = gem_content_artifact
+        self._spec_content_artifact = spec_content_artifact
+        self._remote = remote
+        self._remote_artifact = remote_artifact
+
+    async def prepare(self, request):
+        if self._gem_content_artifact.artifact is not None:
+            spec_data = await sync_to_async(_generate_gemspec, thread_sensitive=False)(
+                self._path, self._gem_content_artifact, self._spec_content_artifact
+            )
+        else:
+            downloader = self._remote.get_downloader(remote_artifact=self._remote_artifact)
+            try:
+                download_result = await downloader.run()
+            except (ClientError, TimeoutException, SizeValidationError, DigestValidationError) as e:
+                log.warning("Could not download %s: %s", self._remote_artifact.url, e)
+                if isinstance(e, DigestValidationError):
+                    # Ignore the corrupted remote for a while, like the content app does.
+                    self._remote_artifact.failed_at = timezone.now()
+                    await self._remote_artifact.asave()
+                if downloader.path and os.path.exists(downloader.path):
+                    os.remove(downloader.path)
+                self.set_status(404)
+                return await super().prepare(request)
+            finally:
+                if hasattr(downloader, "session"):
+                    await downloader.session.close()
+            spec_data = await sync_to_async(_generate_downloaded_gemspec, thread_sensitive=False)(
+                self._path, self._gem_content_artifact, self._remote, download_result
+            )
+        self.content_type = "application/octet-stream"
+        self.content_length = len(spec_data)
+        writer = await super().prepare(request)
+        if request.method != "HEAD":
+            await self.write(spec_data)
+        return writer
+
 
 class GemContent(Content):
     """
@@ -34,6 +239,8 @@ class GemContent(Content):
     _pulp_domain = models.ForeignKey("core.Domain", default=get_domain_pk, on_delete=models.PROTECT)
     name = models.TextField(blank=False, null=False)
     version = models.TextField(blank=False, null=False)
+    # The version encoded to sort like Gem::Version, see `ruby_ver_db_key`.
+    version_key = models.TextField(db_collation="C")
     platform = models.TextField(blank=False, null=False)
     checksum = models.CharField(max_length=64, null=False, db_index=True)
     prerelease = models.BooleanField(default=False)
@@ -49,7 +256,7 @@ class GemContent(Content):
     @property
     def gemspec_path(self):
         """The path for this gem's gemspec for the content app."""
-        return f"quick/Marshal.4.8/{self.name}-{self.ext_version}.gemspec.rz"
+        return f"{GEMSPECS_PREFIX}{self.name}-{self.ext_version}.gemspec.rz"
 
     @property
     def ext_version(self):
@@ -63,18 +270,13 @@ class GemContent(Content):
 
     @staticmethod
     def init_from_artifact_and_relative_path(artifact, relative_path):
-        gem_info, spec_data = analyse_gem(artifact.file)
+        gem_info, _spec_data = analyse_gem(artifact.file)
         gem_info["checksum"] = artifact.sha256
         content = GemContent(**gem_info)
         relative_path = content.relative_path
-
-        with NamedTemporaryFile(mode="wb", dir=".", delete=False) as temp_file:
-            temp_file.write(spec_data)
-            temp_file.flush()
-
         spec_relative_path = content.gemspec_path
 
-        # Spec artifact will be on-demand at this point
+        # The gemspec is generated from the gem by the distribution when it is first requested.
         artifacts = {relative_path: artifact, spec_relative_path: None}
         return content, artifacts
 
@@ -87,6 +289,7 @@ class GemContent(Content):
             "_pulp_domain",
             "checksum",
         )
+        indexes = [models.Index(fields=["name", "platform", "version_key"])]
 
 
 class GemDistribution(Distribution, AutoAddObjPermsMixin):
@@ -97,6 +300,125 @@ class GemDistribution(Distribution, AutoAddObjPermsMixin):
     TYPE = "gem"
     SERVE_FROM_PUBLICATION = True
 
+    def content_headers_for(self, path):
+        """Mark the compact index files as depending on the Accept-Encoding of the request."""
+        if is_compact_index_path(path):
+            return {"Vary": "Accept-Encoding"}
+        return {}
+
+    def content_handler(self, path):
+        """Serve the compact index files and the gemspecs that were not synced."""
+        if self.checkpoint:
+            return None
+        if is_compact_index_path(path):
+            return self._compact_index_handler(path)
+        if path.startswith(GEMSPECS_PREFIX) and path.endswith(".gemspec.rz"):
+            return self._gemspec_handler(path)
+        return None
+
+    def _compact_index_handler(self, path):
+        """
+        Serve the compact index files with their digests, as a gzip compressed variant if
+        published and accepted.
+
+        The files carry a strong ETag and their sha256 in Repr-Digest and Digest headers, that
+        `pulp_gem.app.content` uses to answer conditional requests. Ranges are always served from
+        the uncompressed file, so clients can keep appending to their copy of the versions file.
+
+        The content cache does not tell requests apart by their headers, so only the uncompressed
+        files are served when it is enabled. Storages that redirect clients to the object storage
+        are left to the regular handler, so the files are not streamed through the content app.
+        """
+        domain = get_domain()
+        if domain.storage_class != FILESYSTEM_STORAGE and domain.redirect_to_object_storage:
+            return None
+        publication = self.get_repository_publication_and_version()[2]
+        if publication is None:
+            return None
+        relative_paths = [path]
+        if not settings.CACHE_ENABLED and _accepts_gzip(current_request.get()):
+            relative_paths.insert(0, GZIP_VARIANTS_PREFIX + path)
+        artifacts = {
+            published_artifact.relative_path: published_artifact.content_artifact.artifact
+            for published_artifact in PublishedArtifact.objects.filter(
+                publication=publication, relative_path__in=relative_paths
+            ).select_related("content_artifact__artifact")
+        }
+        for relative_path in relative_paths:
+            if (artifact := artifacts.get(relative_path)) is not None:
+                break
+        else:
+            return None
+
+        digest = base64.b64encode(bytes.fromhex(artifact.sha256)).decode()
+        headers = {
+            "ETag": f'"{artifact.md5 or artifact.sha256}"',
+            "Repr-Digest": f"sha-256=:{digest}:",
+            "Digest": f"sha-256={digest}",
+            "Vary": "Accept-Encoding",
+        }
+        if relative_path != path:
+            headers["Content-Encoding"] = "gzip"
+        return ArtifactResponse(artifact, headers=headers)
+
+    def _gemspec_handler(self, path):
+        """
+        Serve a gemspec that is not stored, generated from the gem file.
+
+        This is the case for gems synced with `generate_gemspecs` or a deferred download policy,
+        and for gems pulled through. When the gem file is stored, the generated gemspec is saved
+        as the artifact of the gemspec, unless it comes from a `streamed` remote, so it is
+        generated only once. Otherwise the gem file is downloaded to generate it, and stored along
+        with the gemspec unless the remote is `streamed`.
+
+        Found content artifacts are returned, so the regular handler does not look them up again.
+        """
+        publication = self.get_repository_publication_and_version()[2]
+        if publication is None:
+            return None
+        spec_content_artifact = (
+            ContentArtifact.objects.filter(
+                content__in=publication.repository_version.content, relative_path=path
+            )
+            .select_related("artifact")
+            .first()
+        )
+        if spec_content_artifact is not None and spec_content_artifact.artifact is not None:
+            return spec_content_artifact
+        gem_path = f"gems/{path[len(GEMSPECS_PREFIX) : -len('.gemspec.rz')]}.gem"
+        if spec_content_artifact is None:
+            gem_content_artifacts = ContentArtifact.objects.filter(
+                content__in=publication.repository_version.content, relative_path=gem_path
+            )
+        else:
+            gem_content_artifacts = ContentArtifact.objects.filter(
+                content_id=spec_content_artifact.content_id, relative_path=gem_path
+            )
+        gem_content_artifact = gem_content_artifacts.select_related("artifact").first()
+        if gem_content_artifact is None:
+            return spec_content_artifact
+        if gem_content_artifact.artifact is not None:
+            return _GeneratedGemspecResponse(path, gem_content_artifact, spec_content_artifact)
+        if spec_content_artifact is not None:
+            # Fetching the gemspec is cheaper than fetching the gem.
+            return spec_content_artifact
+
+        cooldown = timedelta(seconds=settings.REMOTE_CONTENT_FETCH_FAILURE_COOLDOWN)
+        remote_artifact = (
+            RemoteArtifact.objects.filter(content_artifact=gem_content_artifact)
+            .exclude(failed_at__gte=timezone.now() - cooldown)
+            .select_related("remote")
+            .first()
+        )
+        if remote_artifact is None:
+            return None
+        return _GeneratedGemspecResponse(
+            path,
+            gem_content_artifact,
+            remote=remote_artifact.remote.cast(),
+            remote_artifact=remote_artifact,
+        )
+
     class Meta:
         default_related_name = "%(app_label)s_%(model_name)s"
         permissions = [
@@ -107,10 +429,33 @@ class GemDistribution(Distribution, AutoAddObjPermsMixin):
 class GemPublication(Publication, AutoAddObjPermsMixin):
     """
     A Publication for GemContent.
+
+    Fields:
+        index_formats (models.TextField): The published index formats, the compact index, the
+            legacy Marshal specs files or both.
+        gzip_compact_index (models.BooleanField): Whether gzip compressed variants of the compact
+            index files were published along with them.
+        html_index (models.BooleanField): Whether the html index pages were generated.
+        html_index_page_size (models.PositiveIntegerField): The number of links per html index
+            page of the gems, gemspecs and info files. Null for a single page.
     """
 
     TYPE = "gem"
 
+    COMPACT_INDEX = "compact_index"
+    SPECS = "specs"
+    BOTH = "both"
+    INDEX_FORMAT_CHOICES = (
+        (COMPACT_INDEX, "Compact index"),
+        (SPECS, "Legacy specs"),
+        (BOTH, "Both"),
+    )
+
+    index_formats = models.TextField(choices=INDEX_FORMAT_CHOICES, default=BOTH)
+    gzip_compact_index = models.BooleanField(default=False)
+    html_index = models.BooleanField(default=True)
+    html_index_page_size = models.PositiveIntegerField(null=True)
+
     class Meta:
         default_related_name = "%(app_label)s_%(model_name)s"
         permissions = [
@@ -121,6 +466,10 @@ class GemPublication(Publication, AutoAddObjPermsMixin):
 class GemRemote(Remote, AutoAddObjPermsMixin):
     """
     A Remote for GemContent.
+
+    Fields:
+        generate_gemspecs (models.BooleanField): Whether to generate the gemspecs from the gem
+            files instead of downloading them.
     """
 
     TYPE = "gem"
@@ -128,6 +477,7 @@ class GemRemote(Remote, AutoAddObjPermsMixin):
     prereleases = models.BooleanField(default=False)
     includes = HStoreField(null=True)
     excludes = HStoreField(null=True)
+    generate_gemspecs = models.BooleanField(default=False)
 
     def get_remote_artifact_content_type(self, relative_path=None):
         """
@@ -153,12 +503,19 @@ class GemRemote(Remote, AutoAddObjPermsMixin):
 class GemRepository(Repository, AutoAddObjPermsMixin):
     """
     A Repository for GemContent.
+
+    Fields:
+        last_sync_details (models.JSONField): The parameters of the last sync and the number of the
+            repository version it produced. Used to decide whether the info checksums recorded
+            for this repository can be trusted on the next sync.
     """
 
     TYPE = "gem"
     CONTENT_TYPES = [GemContent]
     REMOTE_TYPES = [GemRemote]
 
+    last_sync_details = models.JSONField(default=dict)
+
     class Meta:
         default_related_name = "%(app_label)s_%(model_name)s"
         permissions = [
@@ -167,3 +524,27 @@ class GemRepository(Repository, AutoAddObjPermsMixin):
             ("manage_roles_gemrepository", "Can manage roles on gem repositories"),
             ("repair_gemrepository", "Can repair repository versions"),
         ]
+
+
+class GemInfoChecksum(BaseModel):
+    """
+    The md5 checksum of a gem's info file as last synced into a repository.
+
+    A gem whose info file checksum did not change since the last sync can carry over its content
+    from the previous repository version without fetching the info file again.
+
+    Fields:
+        name (models.TextField): The name of the gem.
+        md5 (models.TextField): The md5 checksum of the info file from the remote's versions file.
+
+    Relations:
+        repository (models.ForeignKey): The repository that was synced.
+    """
+
+    repository = models.ForeignKey(GemRepository, on_delete=models.CASCADE)
+    name = models.TextField()
+    md5 = models.TextField()
+
+    class Meta:
+        default_related_name = "%(app_label)s_%(model_name)s"
+        unique_together = ("repository", "name")
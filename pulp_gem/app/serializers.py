@@ -1,14 +1,15 @@
-import hashlib
 import os
-import tempfile
 from gettext import gettext as _
 
+from django.conf import settings
 from django.db import DatabaseError
 from rest_framework.serializers import (
     BooleanField,
     CharField,
     ChoiceField,
     HStoreField,
+    IntegerField,
+    ValidationError,
 )
 
 from pulpcore.plugin.models import Artifact, Publication, Remote, Repository
@@ -23,32 +24,20 @@ from pulpcore.plugin.serializers import (
     SingleContentArtifactField,
 )
 from pulpcore.plugin.serializers.content import UploadSerializerFieldsMixin
-from pulpcore.plugin.util import get_domain_pk
+from pulpcore.plugin.util import get_domain, get_domain_pk
 
 from pulp_gem.app.models import (
+    FILESYSTEM_STORAGE,
     GemContent,
     GemDistribution,
     GemPublication,
     GemRemote,
     GemRepository,
+    _artifact_from_data,
 )
 from pulp_gem.specs import analyse_gem
 
 
-def _artifact_from_data(raw_data):
-    sha256 = hashlib.sha256(raw_data).hexdigest()
-    artifact = Artifact.objects.filter(sha256=sha256).first()
-    if artifact:
-        return artifact
-
-    with tempfile.NamedTemporaryFile("wb", dir=".", delete=False) as tmpfile:
-        tmpfile.write(raw_data)
-
-    artifact = Artifact.init_and_validate(tmpfile.name, expected_digests={"sha256": sha256})
-    artifact.save()
-    return artifact
-
-
 class GemContentSerializer(MultipleArtifactContentSerializer, UploadSerializerFieldsMixin):
     """
     A Serializer for GemContent.
@@ -161,9 +150,21 @@ class GemRemoteSerializer(RemoteSerializer):
     prereleases = BooleanField(default=False)
     includes = HStoreField(required=False, allow_null=True)
     excludes = HStoreField(required=False, allow_null=True)
+    generate_gemspecs = BooleanField(
+        help_text=_(
+            "Generate the gemspecs from the gem files instead of downloading them from the "
+            "remote. With a deferred download policy, they are generated by the content app."
+        ),
+        default=False,
+    )
 
     class Meta:
-        fields = RemoteSerializer.Meta.fields + ("prereleases", "includes", "excludes")
+        fields = RemoteSerializer.Meta.fields + (
+            "prereleases",
+            "includes",
+            "excludes",
+            "generate_gemspecs",
+        )
         model = GemRemote
 
 
@@ -182,8 +183,70 @@ class GemPublicationSerializer(PublicationSerializer):
     A Serializer for GemPublication.
     """
 
+    compact_versions = BooleanField(
+        help_text=_(
+            "Rewrite the versions file from scratch instead of appending the changes to the "
+            "one of the previous publication. Appending keeps the files cached by clients valid."
+        ),
+        default=False,
+        write_only=True,
+    )
+    gzip_compact_index = BooleanField(
+        help_text=_(
+            "Publish gzip compressed variants of the compact index files, served to clients that "
+            "accept them."
+        ),
+        default=False,
+    )
+
+    index_formats = ChoiceField(
+        help_text=_(
+            "The index formats to publish: 'compact_index' for the names, versions and info "
+            "files used by Bundler, 'specs' for the legacy Marshal specs files, or 'both'."
+        ),
+        choices=GemPublication.INDEX_FORMAT_CHOICES,
+        default=GemPublication.BOTH,
+    )
+    html_index = BooleanField(
+        help_text=_("Generate the html index pages of the publication."),
+        default=True,
+    )
+    html_index_page_size = IntegerField(
+        help_text=_(
+            "Split the html index pages of the gems, gemspecs and info files into pages of this "
+            "many links. All links are listed on a single page if not set."
+        ),
+        min_value=1,
+        required=False,
+        allow_null=True,
+        default=None,
+    )
+
+    def validate_gzip_compact_index(self, value):
+        """The gzip compressed variants could never be served with some content app setups."""
+        if value:
+            if settings.CACHE_ENABLED:
+                raise ValidationError(
+                    _("The gzip compressed variants can not be served with the content cache.")
+                )
+            domain = get_domain()
+            if domain.storage_class != FILESYSTEM_STORAGE and domain.redirect_to_object_storage:
+                raise ValidationError(
+                    _(
+                        "The gzip compressed variants can not be served when clients are "
+                        "redirected to the object storage."
+                    )
+                )
+        return value
+
     class Meta:
-        fields = PublicationSerializer.Meta.fields
+        fields = PublicationSerializer.Meta.fields + (
+            "compact_versions",
+            "index_formats",
+            "gzip_compact_index",
+            "html_index",
+            "html_index_page_size",
+        )
         model = GemPublication
 
 
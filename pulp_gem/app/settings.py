@@ -4,3 +4,8 @@ Check `Plugin Writer's Guide`_ for more details.
 .. _Plugin Writer's Guide:
     http://docs.pulpproject.org/en/3.0/nightly/plugins/plugin-writer/index.html
 """
+
+# The number of generated publication files to upload to the storage in parallel.
+GEM_PUBLISH_UPLOAD_WORKERS = 8
+# The compression level (0-9) of the gzip compressed specs files generated on publish.
+GEM_PUBLISH_GZIP_LEVEL = 9
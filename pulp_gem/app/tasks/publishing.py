@@ -1,29 +1,42 @@
+import asyncio
 import datetime
 import gzip
 import hashlib
 import logging
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from gettext import gettext as _
+from itertools import groupby, islice
+from operator import itemgetter
 from pathlib import Path
 
 from django.conf import settings
 from django.core.files import File
 from django.db import transaction
+from django.db.models import Q
 from jinja2 import Template
 
 from pulpcore.plugin.models import (
+    Artifact,
     ContentArtifact,
     PublishedArtifact,
     PublishedMetadata,
     RepositoryVersion,
 )
 
-from pulp_gem.app.models import GemContent, GemPublication
-from pulp_gem.specs import GemKey, ruby_ver_cmp, write_specs
+from pulp_gem.app.models import GZIP_VARIANTS_PREFIX, GemContent, GemPublication
+from pulp_gem.specs import read_versions, write_specs
 
 log = logging.getLogger(__name__)
 
+# The number of files to publish at once.
+BULK_BATCH_SIZE = 1000
+
+# The md5 sum of an info file without any versions.
+EMPTY_INFO_MD5 = hashlib.md5(b"---\n").hexdigest()
+
 
 index_template = """<!DOCTYPE html>
 <html>
@@ -39,69 +52,473 @@ index_template = """<!DOCTYPE html>
     {% for link in links %}
     <a href="{{ link|e }}">{{ link|e }}</a><br/>
     {% endfor %}
+    {% if previous_page -%}
+    <a href="{{ previous_page }}">Previous</a>
+    {% endif -%}
+    {% if next_page -%}
+    <a href="{{ next_page }}">Next</a>
+    {% endif -%}
   </body>
 </html>
 """
+# Compiled once, it is rendered for every index page of every publication.
+INDEX_TEMPLATE = Template(index_template)
+
+
+def _ext_version(version, platform):
+    """The version with the appended platform if not "ruby"."""
+    return version if platform == "ruby" else f"{version}-{platform}"
+
+
+def _write_specs_files(specs_qs, relative_path):
+    """
+    Write a specs file and its gzip compressed variant.
+
+    Args:
+        specs_qs (QuerySet): The (name, version, platform) rows of the specs, in order.
+        relative_path (str): The path of the specs file.
+
+    Returns:
+        list: The paths of the written files.
+    """
+    write_specs(
+        specs_qs.iterator(chunk_size=2000),
+        relative_path,
+        count=specs_qs.count(),
+        gzip_level=settings.GEM_PUBLISH_GZIP_LEVEL,
+    )
+    return [relative_path, relative_path + ".gz"]
+
+
+def _gzip_open(relative_path):
+    """Open a gzip file for writing that is reproducible, so identical files share an artifact."""
+    return gzip.GzipFile(
+        relative_path, "wb", compresslevel=settings.GEM_PUBLISH_GZIP_LEVEL, mtime=0
+    )
 
 
-def _publish_specs(specs, relative_path, publication):
-    write_specs(specs, relative_path)
+def _write_gzip_variant(relative_path):
+    """
+    Write the gzip compressed variant of a file.
+
+    Returns:
+        str: The path of the written variant.
+    """
+    gzip_path = GZIP_VARIANTS_PREFIX + relative_path
     with open(relative_path, "rb") as f_in:
-        with gzip.open(relative_path + ".gz", "wb") as f_out:
+        with _gzip_open(gzip_path) as f_out:
             shutil.copyfileobj(f_in, f_out)
-    PublishedMetadata.create_from_file(
-        publication=publication, file=File(open(relative_path, "rb"))
+    return gzip_path
+
+
+def _write_compact_index(lines, relative_path, timestamp=False, append=False, gzip_path=None):
+    """
+    Write a compact index file.
+
+    If `gzip_path` is given, a gzip compressed variant is written there at the same time.
+
+    Returns:
+        str: The md5 sum of the written data.
+    """
+    md5 = hashlib.md5()
+    with ExitStack() as stack:
+        fp = stack.enter_context(open(relative_path, "ab" if append else "wb"))
+        gzip_fp = stack.enter_context(_gzip_open(gzip_path)) if gzip_path else None
+
+        def write(text):
+            data = text.encode()
+            md5.update(data)
+            fp.write(data)
+            if gzip_fp is not None:
+                gzip_fp.write(data)
+
+        if not append:
+            if timestamp:
+                timestamp = datetime.datetime.utcnow().isoformat(timespec="seconds")
+                write(f"created_at: {timestamp}Z\n")
+            write("---\n")
+        for line in lines:
+            write(line + "\n")
+    return md5.hexdigest()
+
+
+def _bulk_publish_artifacts(artifact_pks, publication):
+    """
+    Publish existing artifacts as metadata.
+
+    Args:
+        artifact_pks (dict): The pk of the artifact to publish by relative path.
+        publication (GemPublication): The publication to add the metadata to.
+    """
+    with transaction.atomic():
+        content_artifacts = []
+        for relative_path, artifact_pk in artifact_pks.items():
+            # PublishedMetadata uses multi-table inheritance, which bulk_create does not support.
+            pm = PublishedMetadata.objects.create(
+                relative_path=relative_path, publication=publication
+            )
+            content_artifacts.append(
+                ContentArtifact(relative_path=relative_path, content=pm, artifact_id=artifact_pk)
+            )
+        ContentArtifact.objects.bulk_create(content_artifacts, batch_size=BULK_BATCH_SIZE)
+        PublishedArtifact.objects.bulk_create(
+            (
+                PublishedArtifact(
+                    relative_path=ca.relative_path, content_artifact=ca, publication=publication
+                )
+                for ca in content_artifacts
+            ),
+            batch_size=BULK_BATCH_SIZE,
+        )
+
+
+def _bulk_publish_files(relative_paths, publication):
+    """
+    Publish local files as metadata in one go.
+
+    The files are hashed locally and uploaded to the storage in parallel. Only then are the
+    artifacts and metadata created in the database, in bulk.
+
+    Args:
+        relative_paths (list): The paths of the files to publish, relative to the working directory
+            and the publication alike. The metadata is created in this order.
+        publication (GemPublication): The publication to add the metadata to.
+
+    Returns:
+        dict: The pk of the published artifact by relative path.
+    """
+    domain = publication.pulp_domain
+    storage = domain.get_storage()
+    artifacts = {
+        relative_path: Artifact.init_and_validate(relative_path) for relative_path in relative_paths
+    }
+    # Identical files share an artifact.
+    files = {artifact.sha256: relative_path for relative_path, artifact in artifacts.items()}
+    existing = {
+        artifact.sha256: artifact
+        for artifact in Artifact.objects.filter(pulp_domain=domain, sha256__in=files)
+    }
+    new_artifacts = []
+    uploads = []
+    for sha256, relative_path in files.items():
+        if (artifact := existing.get(sha256)) is not None:
+            uploads.append((relative_path, artifact.file.name, True))
+        else:
+            artifact = artifacts[relative_path]
+            storage_path = artifact.storage_path("")
+            uploads.append((relative_path, storage_path, False))
+            # The file is in place once uploaded, so saving it will not upload it again.
+            artifact.file = storage_path
+            new_artifacts.append(artifact)
+
+    def upload(relative_path, storage_path, check_exists):
+        if check_exists and storage.exists(storage_path):
+            return
+        with open(relative_path, "rb") as fp:
+            storage.save(storage_path, File(fp))
+
+    with ThreadPoolExecutor(max_workers=settings.GEM_PUBLISH_UPLOAD_WORKERS) as executor:
+        for future in [executor.submit(upload, *args) for args in uploads]:
+            future.result()
+
+    Artifact.objects.filter(pk__in=[artifact.pk for artifact in existing.values()]).touch()
+    Artifact.objects.bulk_create(new_artifacts, batch_size=BULK_BATCH_SIZE, ignore_conflicts=True)
+    # Conflicting artifacts were created concurrently; look up the stored ones.
+    artifact_pks = dict(
+        Artifact.objects.filter(pulp_domain=domain, sha256__in=files).values_list("sha256", "pk")
     )
-    PublishedMetadata.create_from_file(
-        publication=publication, file=File(open(relative_path + ".gz", "rb"))
+    published = {
+        relative_path: artifact_pks[artifact.sha256]
+        for relative_path, artifact in artifacts.items()
+    }
+    _bulk_publish_artifacts(published, publication)
+    return published
+
+
+def _publish_info_files(gems_qs, publication):
+    """
+    Write and publish the info files of all gems in the queryset.
+
+    Their gzip compressed variants are published along if the publication asks for them.
+
+    Returns:
+        dict: The ext_versions listed in the info file and its md5 sum by gem name.
+    """
+    info_files = {}
+    batch = []
+    # Stream all gems in a single query, grouped by name, to write one info file at a time.
+    info_rows = (
+        gems_qs.order_by("name", "version_key", "platform")
+        .values_list(
+            "name",
+            "version",
+            "platform",
+            "dependencies",
+            "checksum",
+            "required_ruby_version",
+            "required_rubygems_version",
+        )
+        .iterator(chunk_size=2000)
     )
+    for name, rows in groupby(info_rows, key=itemgetter(0)):
+        lines = []
+        version_list = []
+        for _name, version, platform, dependencies, checksum, ruby, rubygems in rows:
+            ext_version = _ext_version(version, platform)
+            deps = ",".join((f"{key}:{value}" for key, value in dependencies.items()))
+            line = f"{ext_version} {deps}|checksum:{checksum}"
+            if ruby:
+                line += f",ruby:{ruby}"
+            if rubygems:
+                line += f",rubygems:{rubygems}"
+            lines.append(line)
+            version_list.append(ext_version)
+        info_path = f"info/{name}"
+        gzip_path = None
+        if publication.gzip_compact_index:
+            gzip_path = GZIP_VARIANTS_PREFIX + info_path
+            batch.append(gzip_path)
+        info_files[name] = (
+            version_list,
+            _write_compact_index(lines, info_path, gzip_path=gzip_path),
+        )
+        batch.append(info_path)
+        if len(batch) >= BULK_BATCH_SIZE:
+            _bulk_publish_files(batch, publication)
+            batch = []
+    if batch:
+        _bulk_publish_files(batch, publication)
+    return info_files
 
 
-def _publish_compact_index(lines, relative_path, publication, timestamp=False, with_list=False):
-    with open(relative_path, "w") as fp:
-        if timestamp:
-            timestamp = datetime.datetime.utcnow().isoformat(timespec="seconds")
-            fp.write(f"created_at: {timestamp}Z\n")
-        fp.write("---\n")
-        for line in lines:
-            fp.write(line + "\n")
-    metadata = PublishedMetadata.create_from_file(
-        publication=publication, file=File(open(relative_path, "rb"))
+def _previous_publication(repository_version):
+    """Return the latest complete publication of the repository, if any."""
+    return (
+        GemPublication.objects.filter(
+            repository_version__repository=repository_version.repository, complete=True
+        )
+        .select_related("repository_version")
+        .order_by("-pulp_created")
+        .first()
     )
-    if with_list:
-        with transaction.atomic():
-            list_path = relative_path + ".list"
-            pm = PublishedMetadata.objects.create(relative_path=list_path, publication=publication)
-            ca = ContentArtifact.objects.create(
-                relative_path=list_path, content=pm, artifact=metadata._artifacts.first()
+
+
+def _fetch_published_versions(publication, relative_path):
+    """
+    Copy the versions file of a publication to a local file.
+
+    Returns:
+        dict: The ext_versions and md5 sum listed by gem name. None if there is no versions file.
+    """
+    content_artifact = (
+        ContentArtifact.objects.filter(
+            content__in=PublishedMetadata.objects.filter(
+                publication=publication, relative_path="versions"
             )
-            PublishedArtifact.objects.create(
-                relative_path=list_path, content_artifact=ca, publication=publication
+        )
+        .select_related("artifact")
+        .first()
+    )
+    if content_artifact is None or content_artifact.artifact is None:
+        return None
+    with content_artifact.artifact.file.open("rb") as f_in:
+        with open(relative_path, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+
+    async def _read():
+        return {
+            name: (ext_versions, md5_sum)
+            async for name, ext_versions, md5_sum in read_versions(relative_path)
+        }
+
+    return asyncio.get_event_loop().run_until_complete(_read())
+
+
+def _append_versions_lines(info_files, previous_versions):
+    """
+    Return the lines to append to the previous versions file for the changed gems.
+
+    Added versions are listed as they are, removed ones are prefixed with "-", as on rubygems.org.
+    A gem whose info file changed with the same versions, e.g. for new dependencies of a version,
+    gets its last version removed and added again, so that the line still lists a version.
+    """
+    for name, (ext_versions, md5_sum) in info_files.items():
+        previous_ext_versions, previous_md5_sum = previous_versions.get(name, ([], None))
+        if md5_sum == previous_md5_sum:
+            continue
+        kept = set(previous_ext_versions)
+        listed = set(ext_versions)
+        changes = [v for v in ext_versions if v not in kept]
+        changes += [f"-{v}" for v in previous_ext_versions if v not in listed]
+        if not changes and ext_versions:
+            changes = [f"-{ext_versions[-1]}", ext_versions[-1]]
+        yield f"{name} {','.join(changes)} {md5_sum}"
+
+
+def _published_info_artifacts(publication):
+    """
+    Return the artifact pk of each info file in the publication by relative path.
+
+    This includes the gzip compressed variants of the info files.
+    """
+    return dict(
+        ContentArtifact.objects.filter(
+            content__in=PublishedMetadata.objects.filter(
+                Q(relative_path__startswith="info/")
+                | Q(relative_path__startswith=GZIP_VARIANTS_PREFIX + "info/"),
+                publication=publication,
             )
-    return metadata
+        ).values_list("relative_path", "artifact")
+    )
+
+
+def _index_page_name(number):
+    """The file name of an index page, the first one being index.html."""
+    return "index.html" if number == 1 else f"index-{number}.html"
+
+
+def _write_index(path="", links=None, page_size=None):
+    """
+    Write html index pages listing the links.
 
+    The links are split into pages of `page_size` links, chained by "Previous" and "Next" links.
+    Without a `page_size`, all links are listed on a single page.
 
-def _create_index(publication, path="", links=None):
+    Returns:
+        list: The paths of the written pages.
+    """
     links = links or []
     links = (li if li.endswith("/") else str(Path(li).relative_to(path)) for li in links)
-    template = Template(index_template)
-    index_path = f"{path}index.html"
     if path:
         Path(path).mkdir(exist_ok=True)
-    with open(index_path, "w") as index:
-        index.write(template.render(links=links, path=path))
+    index_paths = []
+    page = islice(links, page_size)
+    while True:
+        number = len(index_paths) + 1
+        page = list(page) if page_size else page
+        next_page = list(islice(links, page_size)) if page_size else []
+        index_path = f"{path}{_index_page_name(number)}"
+        with open(index_path, "w") as index:
+            INDEX_TEMPLATE.stream(
+                links=page,
+                path=path,
+                previous_page=_index_page_name(number - 1) if number > 1 else None,
+                next_page=_index_page_name(number + 1) if next_page else None,
+            ).dump(index)
+        index_paths.append(index_path)
+        if not next_page:
+            return index_paths
+        page = next_page
 
-    return PublishedMetadata.create_from_file(
-        relative_path=index_path, publication=publication, file=File(open(index_path, "rb"))
-    )
 
+def _publish_compact_index(publication, gems_qs, compact_versions):
+    """
+    Write the compact index files, publishing the info files.
+
+    The names and versions files, and the gzip compressed variants of them if the publication
+    asks for them, are left to be published by the caller.
+
+    Returns:
+        tuple: The paths of the files left to be published and the names of all gems.
+    """
+    generated_paths = []
+    names_qs = gems_qs.order_by("name").values_list("name", flat=True).distinct()
+    os.mkdir("info")
+    if publication.gzip_compact_index:
+        os.makedirs(GZIP_VARIANTS_PREFIX + "info")
+        _write_compact_index(names_qs, "names", gzip_path=GZIP_VARIANTS_PREFIX + "names")
+        generated_paths.append(GZIP_VARIANTS_PREFIX + "names")
+    else:
+        _write_compact_index(names_qs, "names")
+    generated_paths.append("names")
+
+    repository_version = publication.repository_version
+    previous_publication = _previous_publication(repository_version)
+    previous_versions = None
+    if previous_publication is not None:
+        previous_versions = _fetch_published_versions(previous_publication, "versions")
+    if previous_versions is None:
+        info_files = _publish_info_files(gems_qs, publication)
+        info_names = list(info_files)
+    else:
+        # Only the info files of gems with added or removed versions need to be written.
+        # The others are published again from the artifacts of the previous publication.
+        previous_version = previous_publication.repository_version
+        changed_names = GemContent.objects.filter(
+            Q(pk__in=repository_version.added(previous_version))
+            | Q(pk__in=repository_version.removed(previous_version))
+        ).values("name")
+        info_files = _publish_info_files(gems_qs.filter(name__in=changed_names), publication)
+        previous_info = _published_info_artifacts(previous_publication)
+        info_names = []
+        missing_names = []
+        reused_info = {}
+        for name in names_qs.iterator():
+            info_names.append(name)
+            if name in info_files:
+                continue
+            info_paths = [f"info/{name}"]
+            if publication.gzip_compact_index:
+                info_paths.append(GZIP_VARIANTS_PREFIX + info_paths[0])
+            reused_pks = [previous_info.get(info_path) for info_path in info_paths]
+            if name not in previous_versions or None in reused_pks:
+                missing_names.append(name)
+                continue
+            reused_info.update(zip(info_paths, reused_pks))
+            if len(reused_info) >= BULK_BATCH_SIZE:
+                _bulk_publish_artifacts(reused_info, publication)
+                reused_info = {}
+        if reused_info:
+            _bulk_publish_artifacts(reused_info, publication)
+        if missing_names:
+            info_files.update(
+                _publish_info_files(gems_qs.filter(name__in=missing_names), publication)
+            )
 
-def publish(repository_version_pk):
+    if previous_versions is None or compact_versions:
+        all_info_files = previous_versions or {}
+        all_info_files.update(info_files)
+        versions_lines = (
+            f"{name} {','.join(all_info_files[name][0])} {all_info_files[name][1]}"
+            for name in info_names
+        )
+        _write_compact_index(versions_lines, "versions", timestamp=True)
+    else:
+        # Keep the versions file append-only, so clients can fetch just the new lines.
+        removed_names = sorted(previous_versions.keys() - set(info_names))
+        for name in removed_names:
+            if previous_versions[name][0]:
+                info_files[name] = ([], EMPTY_INFO_MD5)
+        _write_compact_index(
+            _append_versions_lines(info_files, previous_versions), "versions", append=True
+        )
+    generated_paths.append("versions")
+    if publication.gzip_compact_index:
+        generated_paths.append(_write_gzip_variant("versions"))
+    return generated_paths, info_names
+
+
+def publish(
+    repository_version_pk,
+    compact_versions=False,
+    gzip_compact_index=False,
+    html_index=True,
+    html_index_page_size=None,
+    index_formats=GemPublication.BOTH,
+):
     """
     Create a Publication based on a RepositoryVersion.
 
     Args:
         repository_version_pk (str): Create a publication from this repository version.
+        compact_versions (bool): Rewrite the versions file instead of appending to the one of
+            the previous publication.
+        gzip_compact_index (bool): Publish gzip compressed variants of the compact index files.
+        html_index (bool): Generate the html index pages.
+        html_index_page_size (int): The number of links per html index page of the gems, gemspecs
+            and info files. All links are listed on a single page if not set.
+        index_formats (str): The index formats to publish, the compact index, the legacy specs
+            files or both.
 
     """
     repository_version = RepositoryVersion.objects.get(pk=repository_version_pk)
@@ -112,85 +529,78 @@ def publish(repository_version_pk):
         )
     )
     with GemPublication.create(repository_version, pass_through=True) as publication:
-        specs = []
-        latest_versions = {}
-        prerelease_specs = []
-        gems = []
-        gemspecs = []
-        for content in (
-            GemContent.objects.filter(pk__in=publication.repository_version.content)
-            .only("name", "version", "platform", "prerelease")
-            .order_by("-pulp_created")
-            .iterator()
-        ):
-            if content.prerelease:
-                prerelease_specs.append(GemKey(content.name, content.version, content.platform))
-            else:
-                specs.append(GemKey(content.name, content.version, content.platform))
-                old_ver = latest_versions.get((content.name, content.platform))
-                if old_ver is None or ruby_ver_cmp(old_ver, content.version) < 0:
-                    latest_versions[(content.name, content.platform)] = content.version
-            gems.append(content.relative_path)
-            gemspecs.append(content.gemspec_path)
-        latest_specs = [
-            GemKey(name, ver, platform) for (name, platform), ver in latest_versions.items()
-        ]
-
-        _publish_specs(specs, "specs.4.8", publication)
-        _publish_specs(latest_specs, "latest_specs.4.8", publication)
-        _publish_specs(prerelease_specs, "prerelease_specs.4.8", publication)
-
-        # compact_index
+        publication.gzip_compact_index = gzip_compact_index
+        publication.html_index = html_index
+        publication.html_index_page_size = html_index_page_size
+        publication.index_formats = index_formats
         gems_qs = GemContent.objects.filter(pk__in=publication.repository_version.content)
-        names_qs = gems_qs.order_by("name").values_list("name", flat=True).distinct()
-        _publish_compact_index(names_qs, "names", publication, with_list=True)
-
-        versions_lines = []
-        os.mkdir("info")
-        for name in names_qs:
-            lines = []
-            version_list = []
-            for gem in gems_qs.filter(name=name):
-                deps = ",".join((f"{key}:{value}" for key, value in gem.dependencies.items()))
-                line = f"{gem.ext_version} {deps}|checksum:{gem.checksum}"
-                if gem.required_ruby_version:
-                    line += f",ruby:{gem.required_ruby_version}"
-                if gem.required_rubygems_version:
-                    line += f",rubygems:{gem.required_rubygems_version}"
-                lines.append(line)
-                version_list.append(gem.ext_version)
-            info_metadata = _publish_compact_index(lines, f"info/{name}", publication)
-            versions = ",".join(version_list)
-            if "md5" in settings.ALLOWED_CONTENT_CHECKSUMS:
-                md5_sum = info_metadata._artifacts.first().md5
-            else:
-                artifact = info_metadata._artifacts.first()
-                artifact.file.seek(0)
-                md5_sum = hashlib.md5(artifact.file.read()).hexdigest()
-            versions_lines.append(f"{name} {versions} {md5_sum}")
-        _publish_compact_index(
-            versions_lines, "versions", publication, timestamp=True, with_list=True
+        specs_qs = gems_qs.order_by("-pulp_created").values_list("name", "version", "platform")
+        latest_specs_qs = (
+            gems_qs.filter(prerelease=False)
+            .order_by("name", "platform", "-version_key")
+            .distinct("name", "platform")
+            .values_list("name", "version", "platform")
         )
 
-        _create_index(
-            publication,
-            path="",
-            links=[
-                "gems/",
-                "quick/Marshal.4.8/",
-                "specs.4.8",
-                "latest_specs.4.8",
-                "prerelease_specs.4.8",
-                "names",
-                "names.list",
-                "versions",
-                "versions.list",
-                "info/",
-            ],
-        )
-        _create_index(publication, path="gems/", links=gems)
-        _create_index(publication, path="quick/", links=["quick/Marshal.4.8/"])
-        _create_index(publication, path="quick/Marshal.4.8/", links=gemspecs)
-        _create_index(publication, path="info/", links=(f"info/{name}" for name in names_qs))
+        # Files that are generated in full are published together at the end.
+        generated_paths = []
+        if index_formats != GemPublication.COMPACT_INDEX:
+            generated_paths += _write_specs_files(specs_qs.filter(prerelease=False), "specs.4.8")
+            generated_paths += _write_specs_files(latest_specs_qs, "latest_specs.4.8")
+            generated_paths += _write_specs_files(
+                specs_qs.filter(prerelease=True), "prerelease_specs.4.8"
+            )
+        if index_formats != GemPublication.SPECS:
+            compact_index_paths, info_names = _publish_compact_index(
+                publication, gems_qs, compact_versions
+            )
+            generated_paths += compact_index_paths
+
+        if html_index:
+            links = ["gems/"]
+            if index_formats != GemPublication.COMPACT_INDEX:
+                links += [
+                    "quick/Marshal.4.8/",
+                    "specs.4.8",
+                    "latest_specs.4.8",
+                    "prerelease_specs.4.8",
+                ]
+            if index_formats != GemPublication.SPECS:
+                links += ["names", "names.list", "versions", "versions.list", "info/"]
+            generated_paths += _write_index(path="", links=links)
+            generated_paths += _write_index(
+                path="gems/",
+                links=(
+                    f"gems/{name}-{_ext_version(version, platform)}.gem"
+                    for name, version, platform in specs_qs.iterator(chunk_size=2000)
+                ),
+                page_size=html_index_page_size,
+            )
+            if index_formats != GemPublication.COMPACT_INDEX:
+                generated_paths += _write_index(path="quick/", links=["quick/Marshal.4.8/"])
+                generated_paths += _write_index(
+                    path="quick/Marshal.4.8/",
+                    links=(
+                        f"quick/Marshal.4.8/{name}-{_ext_version(version, platform)}.gemspec.rz"
+                        for name, version, platform in specs_qs.iterator(chunk_size=2000)
+                    ),
+                    page_size=html_index_page_size,
+                )
+            if index_formats != GemPublication.SPECS:
+                generated_paths += _write_index(
+                    path="info/",
+                    links=(f"info/{name}" for name in info_names),
+                    page_size=html_index_page_size,
+                )
+
+        artifact_pks = _bulk_publish_files(generated_paths, publication)
+        if index_formats != GemPublication.SPECS:
+            _bulk_publish_artifacts(
+                {
+                    "names.list": artifact_pks["names"],
+                    "versions.list": artifact_pks["versions"],
+                },
+                publication,
+            )
 
     log.info(_("Publication: {publication} created").format(publication=publication.pk))
@@ -1,32 +1,51 @@
+import asyncio
 import logging
+import os
+from collections import deque
 from gettext import gettext as _
 from urllib.parse import urljoin
 
-from aiohttp import ClientConnectionError
+from aiohttp import ClientConnectionError, ClientResponseError
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.db import transaction
 
 from pulpcore.plugin.exceptions import SyncError
-from pulpcore.plugin.models import Artifact, ProgressReport, Remote, Repository
+from pulpcore.plugin.models import Artifact, ProgressReport, Remote
 from pulpcore.plugin.stages import (
     DeclarativeArtifact,
     DeclarativeContent,
     DeclarativeVersion,
+    QueryExistingContents,
     Stage,
 )
 
 from pulp_gem.app.exceptions import RemoteConnectionError
-from pulp_gem.app.models import GemContent, GemRemote
+from pulp_gem.app.models import (
+    GemContent,
+    GemInfoChecksum,
+    GemRemote,
+    GemRepository,
+    _artifact_from_data,
+)
 from pulp_gem.specs import (
     NAME_REGEX,
     PRERELEASE_VERSION_REGEX,
+    analyse_gem,
+    compile_requirements,
     read_info,
+    read_info_versions,
     read_versions,
-    ruby_ver_includes,
+    ruby_ver_db_key,
+    ruby_ver_key,
     split_ext_version,
 )
 
 log = logging.getLogger(__name__)
 
+# Enough to hold the last line of a versions file.
+TAIL_READ_SIZE = 65536
+
 
 def synchronize(remote_pk, repository_pk, mirror=False):
     """
@@ -42,182 +61,548 @@ def synchronize(remote_pk, repository_pk, mirror=False):
 
     """
     remote = GemRemote.objects.get(pk=remote_pk)
-    repository = Repository.objects.get(pk=repository_pk)
+    repository = GemRepository.objects.get(pk=repository_pk)
 
     if not remote.url:
         raise SyncError(_("A remote must have a url specified to synchronize."))
 
-    first_stage = GemFirstStage(remote)
-    dv = DeclarativeVersion(first_stage, repository, mirror=mirror)
+    # The recorded sync state describes the latest repository version only if it was created
+    # by a sync with the very same parameters.
+    sync_params = {
+        "remote": str(remote.pk),
+        "remote_last_updated": str(remote.pulp_last_updated),
+        "mirror": mirror,
+    }
+    last_sync_details = repository.last_sync_details
+    base_version = repository.latest_version()
+    if (
+        last_sync_details.get("params") == sync_params
+        and last_sync_details.get("version") == base_version.number
+    ):
+        known_info_checksums = dict(
+            GemInfoChecksum.objects.filter(repository=repository).values_list("name", "md5")
+        )
+        versions_file = last_sync_details.get("versions_file")
+    else:
+        GemInfoChecksum.objects.filter(repository=repository).delete()
+        known_info_checksums = {}
+        versions_file = None
+
+    first_stage = GemFirstStage(
+        remote,
+        known_info_checksums=known_info_checksums,
+        versions_file=versions_file,
+        # Unchanged gems only need to be carried over when the sync removes missing content.
+        base_version=base_version if mirror else None,
+    )
+    if not asyncio.get_event_loop().run_until_complete(first_stage.download_versions()):
+        log.info(_("The versions file is unchanged upstream; nothing to sync."))
+        return
+    dv = GemDeclarativeVersion(first_stage, repository, mirror=mirror)
     dv.create()
 
+    with transaction.atomic():
+        _update_info_checksums(repository, known_info_checksums, first_stage.info_checksums)
+        repository.last_sync_details = {
+            "params": sync_params,
+            "version": repository.latest_version().number,
+            "versions_file": first_stage.versions_file,
+        }
+        repository.save(update_fields=["last_sync_details"])
+
+
+def _update_info_checksums(repository, old_checksums, new_checksums):
+    """
+    Record the info file checksums seen by a sync of the repository.
+
+    Args:
+        repository (GemRepository): The synced repository.
+        old_checksums (dict): The checksums recorded before the sync by gem name.
+        new_checksums (dict): The checksums seen by the sync by gem name.
+    """
+    changed = [
+        GemInfoChecksum(repository=repository, name=name, md5=md5)
+        for name, md5 in new_checksums.items()
+        if old_checksums.get(name) != md5
+    ]
+    GemInfoChecksum.objects.bulk_create(
+        changed,
+        batch_size=1000,
+        update_conflicts=True,
+        unique_fields=["repository", "name"],
+        update_fields=["md5"],
+    )
+    removed = list(old_checksums.keys() - new_checksums.keys())
+    for i in range(0, len(removed), 1000):
+        GemInfoChecksum.objects.filter(
+            repository=repository, name__in=removed[i : i + 1000]
+        ).delete()
+
 
 class GemFirstStage(Stage):
     """
     The first stage of a pulp_gem sync pipeline.
     """
 
-    def __init__(self, remote):
+    def __init__(self, remote, known_info_checksums=None, versions_file=None, base_version=None):
         """
         The first stage of a pulp_gem sync pipeline.
 
         Args:
             remote (GemRemote): The remote data to be used when syncing
+            known_info_checksums (dict): The info file checksums by gem name as recorded by the
+                last sync. Gems with an unchanged checksum are not fetched again.
+            versions_file (dict): The size, validators and last line of the versions file as
+                fetched by the last sync. If given, only the part appended since is downloaded.
+            base_version (RepositoryVersion): The repository version to carry over the content of
+                unchanged gems from. If None, unchanged gems are not emitted at all.
 
         """
         self.remote = remote
+        self.known_info_checksums = known_info_checksums or {}
+        self.base_version = base_version
+        # The versions file as fetched by the last sync, updated to the one fetched by this sync.
+        self.versions_file = versions_file
+        # The info file checksums seen by this sync by gem name.
+        self.info_checksums = {}
+        # Where the downloaded versions file is stored and where its unseen lines start.
+        self.versions_path = None
+        self.versions_offset = 0
+        # The version filters of the remote compiled by requirements string.
+        self.matchers = {}
 
-    async def run(self):
-        """
-        Build and emit `DeclarativeContent` from the Spec data.
+    async def download_versions(self):
         """
-        # Interpret policy to download Artifacts or not
-        deferred_download = self.remote.policy != Remote.IMMEDIATE
-        remote_url = self.remote.url
-
-        # Read filters from remote
-        includes = self.remote.includes
-        excludes = self.remote.excludes
-        prereleases = self.remote.prereleases
+        Download the versions file ahead of running the pipeline.
 
+        Returns:
+            bool: False if the versions file did not change since the last sync, True otherwise.
+        """
         async with ProgressReport(
             message="Downloading versions list", total=1
         ) as pr_download_versions:
-            versions_url = urljoin(remote_url, "versions")
-            versions_downloader = self.remote.get_downloader(url=versions_url)
             try:
-                versions_result = await versions_downloader.run()
+                self.versions_path, self.versions_offset = await self._download_versions()
             except ClientConnectionError as e:
                 raise RemoteConnectionError(host=e.host)
             await pr_download_versions.aincrement()
+        return self.versions_path is not None
+
+    async def run(self):
+        """
+        Build and emit `DeclarativeContent` from the Spec data.
+
+        `download_versions` must have been awaited and reported a change before.
+        """
+        # Keep enough info downloads scheduled to saturate the downloader; the downloader
+        # factory's semaphore still caps the number of requests in flight.
+        max_pending = 2 * (
+            self.remote.download_concurrency or self.remote.DEFAULT_DOWNLOAD_CONCURRENCY
+        )
+
+        versions_path, offset = self.versions_path, self.versions_offset
+        # A nonzero offset means only the lines appended since the last sync were downloaded.
+        # Every gem not listed there is unchanged.
+        incremental = offset > 0
+        if incremental:
+            self.info_checksums.update(self.known_info_checksums)
 
         async with ProgressReport(message="Parsing versions list") as pr_parse_versions:
             async with ProgressReport(message="Parsing versions info") as pr_parse_info:
-                async for name, ext_versions, md5_sum in read_versions(versions_result.path):
-                    await pr_parse_versions.aincrement()
-
-                    # Skip conditions based on the gem name
-                    # =====================================
-                    if not NAME_REGEX.fullmatch(name):
-                        log.warn(f"Skipping invalid gem name: '{name}'.")
-                        continue
-                    if includes is not None:
-                        if name not in includes:
-                            continue
-                        include_versions = includes[name]
-                    else:
-                        include_versions = None
-                    if excludes is not None and name in excludes:
-                        exclude_versions = excludes[name]
-                        if exclude_versions is None:
+                # Info files are fetched concurrently, but their results are emitted in the
+                # order of the versions list to keep the pipeline input stable.
+                pending = deque()
+                unchanged_names = set()
+                changed_names = set()
+                try:
+                    async for name, ext_versions, md5_sum in read_versions(
+                        versions_path, offset=offset
+                    ):
+                        await pr_parse_versions.aincrement()
+                        if md5_sum is not None:
+                            self.info_checksums[name] = md5_sum
+                            if self.known_info_checksums.get(name) == md5_sum:
+                                unchanged_names.add(name)
+                                continue
+                        changed_names.add(name)
+                        filters = self._name_filters(name)
+                        if filters is None:
                             continue
-                    else:
-                        exclude_versions = None
-
-                    # Skip conditions based on the gem version
-                    # ========================================
-
-                    # Keep a list to track the skipped versions for logging.
-                    kept_versions = set(ext_versions)
-                    # The list 'ext_versions' contains "{version}[-{platform}]" entries!
-                    # This dict is like a set of ext_versions with payload dict on
-                    # {version, platform, prerelease}.
-                    versions_info = {
-                        ext_version: split_ext_version(ext_version) for ext_version in ext_versions
-                    }
-                    # Sanitize versions.
-                    versions_info = {
-                        k: v
-                        for k, v in versions_info.items()
-                        if PRERELEASE_VERSION_REGEX.fullmatch(v["version"])
-                    }
-                    if len(kept_versions) > len(versions_info):
-                        log.warn(
-                            _("Skipped invalid versions for '%s': %s"),
-                            name,
-                            kept_versions - set(versions_info.keys()),
-                        )
-                        kept_versions = set(versions_info.keys())
-
-                    if not prereleases:
-                        # Prerelease versions are already sanitized.
-                        # But for the sake of logging we handle them differently.
-                        versions_info = {
-                            k: v for k, v in versions_info.items() if not v["prerelease"]
-                        }
-                        if len(kept_versions) > len(versions_info):
-                            log.debug(
-                                _("Skipped prerelease versions for '%s': %s"),
-                                name,
-                                kept_versions - set(versions_info.keys()),
-                            )
-                            kept_versions = set(versions_info.keys())
-
-                    if include_versions is not None:
-                        versions_info = {
-                            k: v
-                            for k, v in versions_info.items()
-                            if ruby_ver_includes(include_versions, v["version"])
-                        }
-                        if len(kept_versions) > len(versions_info):
-                            log.debug(
-                                _("Skipped versions for '%s' include filter: %s"),
-                                name,
-                                kept_versions - set(versions_info.keys()),
-                            )
-                            kept_versions = set(versions_info.keys())
-
-                    if exclude_versions is not None:
-                        versions_info = {
-                            k: v
-                            for k, v in versions_info.items()
-                            if not ruby_ver_includes(exclude_versions, v["version"])
-                        }
-                        if len(kept_versions) > len(versions_info):
-                            log.debug(
-                                _("Skipped versions for '%s' exclude filter: %s"),
-                                name,
-                                kept_versions - set(versions_info.keys()),
+                        if incremental:
+                            # The appended lines only list the versions added or yanked lately.
+                            # Take the complete list from the info file instead.
+                            versions_info = None
+                        else:
+                            versions_info = self._filter_versions(name, ext_versions, *filters)
+                            if not versions_info:
+                                continue
+                        pending.append(
+                            asyncio.ensure_future(
+                                self._read_info(name, md5_sum, versions_info, filters)
                             )
-                            kept_versions = set(versions_info.keys())
-
-                    if not versions_info:
-                        log.debug(_("No version left for '%s'; skip reading the info file."), name)
-                        continue
-
-                    info_url = urljoin(urljoin(self.remote.url, "info/"), name)
-                    if "md5" in settings.ALLOWED_CONTENT_CHECKSUMS:
-                        extra_kwargs = {"expected_digests": {"md5": md5_sum}}
-                    elif md5_sum is None:
-                        extra_kwargs = {}
-                        log.warn(f"Checksum of info file for '{name}' was not provided.")
-                    else:
-                        extra_kwargs = {}
-                        log.warn(f"Checksum of info file for '{name}' could not be validated.")
-                    info_downloader = self.remote.get_downloader(url=info_url, **extra_kwargs)
-                    info_result = await info_downloader.run()
-                    async for gem_info in read_info(info_result.path, versions_info):
-                        gem_info["name"] = name
-                        gem = GemContent(**gem_info)
-                        gem_path = gem.relative_path
-                        gem_url = urljoin(remote_url, gem_path)
-                        gemspec_path = gem.gemspec_path
-                        gemspec_url = urljoin(remote_url, gemspec_path)
-
-                        da_gem = DeclarativeArtifact(
-                            artifact=Artifact(sha256=gem_info["checksum"]),
-                            url=gem_url,
-                            relative_path=gem_path,
-                            remote=self.remote,
-                            deferred_download=deferred_download,
                         )
-                        da_gemspec = DeclarativeArtifact(
-                            artifact=Artifact(),
-                            url=gemspec_url,
-                            relative_path=gemspec_path,
-                            remote=self.remote,
-                            deferred_download=deferred_download,
-                        )
-                        dc = DeclarativeContent(content=gem, d_artifacts=[da_gem, da_gemspec])
-                        await pr_parse_info.aincrement()
-                        await self.put(dc)
+                        if len(pending) >= max_pending:
+                            await self._put_all(await pending.popleft(), pr_parse_info)
+                    while pending:
+                        await self._put_all(await pending.popleft(), pr_parse_info)
+                finally:
+                    for future in pending:
+                        future.cancel()
+
+        if self.base_version is not None:
+            if incremental:
+                await self._carry_over(changed_names=changed_names)
+            elif unchanged_names:
+                await self._carry_over(unchanged_names=unchanged_names)
+
+    async def _download_versions(self):
+        """
+        Download the versions file.
+
+        The versions file is append-only, so if it was fetched before, only the part appended
+        since is requested. The request overlaps with the last line fetched before to verify that
+        the file was not rewritten in the meantime. Otherwise the whole file is downloaded.
+
+        The request is made conditional on the validators of the last fetch, so an unchanged
+        file is not transferred at all.
+
+        Returns:
+            tuple: The path of the downloaded file and the offset at which the unseen lines start.
+                A nonzero offset denotes a partial download. The path is None if the file did not
+                change since the last sync.
+        """
+        versions_url = urljoin(self.remote.url, "versions")
+        if self.versions_file:
+            tail = self.versions_file["tail"].encode()
+            start = self.versions_file["size"] - len(tail)
+            headers = {"Range": f"bytes={start}-", "Accept-Encoding": "identity"}
+            if self.versions_file.get("etag"):
+                headers["If-None-Match"] = self.versions_file["etag"]
+            if self.versions_file.get("last_modified"):
+                headers["If-Modified-Since"] = self.versions_file["last_modified"]
+            downloader = self.remote.get_downloader(url=versions_url)
+            try:
+                result = await downloader.run(extra_data={"request_kwargs": {"headers": headers}})
+            except ClientResponseError as e:
+                if e.status != 416:
+                    raise
+                # The file got shorter.
+                result = None
+            if result is not None:
+                if os.path.getsize(result.path) == 0:
+                    # Only a "304 Not Modified" response comes without a body.
+                    return None, 0
+                response_headers = result.headers or {}
+                if "Content-Range" not in response_headers:
+                    # The server ignored the Range header and sent the whole file.
+                    self._update_versions_file(result, 0)
+                    return result.path, 0
+                with open(result.path, "rb") as fp:
+                    overlap = fp.read(len(tail))
+                if overlap == tail:
+                    if os.path.getsize(result.path) == len(tail):
+                        # The server ignored the validators, but nothing was appended either.
+                        return None, 0
+                    self._update_versions_file(result, start)
+                    return result.path, len(tail)
+            log.info(_("The versions file was rewritten upstream; fetching it completely."))
+        downloader = self.remote.get_downloader(url=versions_url)
+        result = await downloader.run()
+        self._update_versions_file(result, 0)
+        return result.path, 0
+
+    def _update_versions_file(self, result, start):
+        """
+        Remember the fetched versions file for the next sync.
+
+        Args:
+            result (DownloadResult): The result of downloading the versions file.
+            start (int): The offset in the versions file at which the download started.
+        """
+        size = os.path.getsize(result.path)
+        with open(result.path, "rb") as fp:
+            fp.seek(max(0, size - TAIL_READ_SIZE))
+            lines = fp.read().splitlines(keepends=True)
+        tail = lines[-1].decode() if lines else ""
+        if not tail.endswith("\n"):
+            # An incomplete last line cannot be used to verify the next download.
+            self.versions_file = None
+            return
+        response_headers = result.headers or {}
+        self.versions_file = {
+            "size": start + size,
+            "etag": response_headers.get("ETag"),
+            "last_modified": response_headers.get("Last-Modified"),
+            "tail": tail,
+        }
+
+    def _name_filters(self, name):
+        """
+        Apply the remote's filters on the name of a gem.
+
+        Args:
+            name (str): The name of the gem.
+
+        Returns:
+            tuple: The include and exclude matchers for the versions of the gem, either of which
+                may be None. None if the gem is not to be synced at all.
+        """
+        # Read filters from remote
+        includes = self.remote.includes
+        excludes = self.remote.excludes
+
+        if not NAME_REGEX.fullmatch(name):
+            log.warn(f"Skipping invalid gem name: '{name}'.")
+            return None
+        if includes is not None:
+            if name not in includes:
+                return None
+            include_versions = includes[name]
+        else:
+            include_versions = None
+        if excludes is not None and name in excludes:
+            exclude_versions = excludes[name]
+            if exclude_versions is None:
+                return None
+        else:
+            exclude_versions = None
+        return self._compile(include_versions), self._compile(exclude_versions)
+
+    def _compile(self, requirements):
+        """Return the compiled matcher for a requirements string, if any."""
+        if requirements is None:
+            return None
+        if (matcher := self.matchers.get(requirements)) is None:
+            matcher = self.matchers[requirements] = compile_requirements(requirements)
+        return matcher
+
+    def _filter_versions(self, name, ext_versions, include_versions, exclude_versions):
+        """
+        Apply the remote's filters on the versions of a gem.
+
+        Args:
+            name (str): The name of the gem.
+            ext_versions (list): The "{version}[-{platform}]" entries listed for the gem.
+            include_versions (callable): The include matcher as returned by `_name_filters`.
+            exclude_versions (callable): The exclude matcher as returned by `_name_filters`.
+
+        Returns:
+            dict: The kept ext_versions with their {version, platform, prerelease} payload.
+                Empty if no version is to be synced.
+        """
+        prereleases = self.remote.prereleases
+
+        # Skip conditions based on the gem version
+        # ========================================
+
+        # Keep a list to track the skipped versions for logging.
+        kept_versions = set(ext_versions)
+        # The list 'ext_versions' contains "{version}[-{platform}]" entries!
+        # This dict is like a set of ext_versions with payload dict on
+        # {version, platform, prerelease}.
+        versions_info = {
+            ext_version: split_ext_version(ext_version) for ext_version in ext_versions
+        }
+        # Sanitize versions.
+        versions_info = {
+            k: v
+            for k, v in versions_info.items()
+            if PRERELEASE_VERSION_REGEX.fullmatch(v["version"])
+        }
+        if len(kept_versions) > len(versions_info):
+            log.warn(
+                _("Skipped invalid versions for '%s': %s"),
+                name,
+                kept_versions - set(versions_info.keys()),
+            )
+            kept_versions = set(versions_info.keys())
+
+        if not prereleases:
+            # Prerelease versions are already sanitized.
+            # But for the sake of logging we handle them differently.
+            versions_info = {k: v for k, v in versions_info.items() if not v["prerelease"]}
+            if len(kept_versions) > len(versions_info):
+                log.debug(
+                    _("Skipped prerelease versions for '%s': %s"),
+                    name,
+                    kept_versions - set(versions_info.keys()),
+                )
+                kept_versions = set(versions_info.keys())
+
+        if include_versions is not None or exclude_versions is not None:
+            version_keys = {k: ruby_ver_key(v["version"]) for k, v in versions_info.items()}
+
+        if include_versions is not None:
+            versions_info = {
+                k: v for k, v in versions_info.items() if include_versions(version_keys[k])
+            }
+            if len(kept_versions) > len(versions_info):
+                log.debug(
+                    _("Skipped versions for '%s' include filter: %s"),
+                    name,
+                    kept_versions - set(versions_info.keys()),
+                )
+                kept_versions = set(versions_info.keys())
+
+        if exclude_versions is not None:
+            versions_info = {
+                k: v for k, v in versions_info.items() if not exclude_versions(version_keys[k])
+            }
+            if len(kept_versions) > len(versions_info):
+                log.debug(
+                    _("Skipped versions for '%s' exclude filter: %s"),
+                    name,
+                    kept_versions - set(versions_info.keys()),
+                )
+                kept_versions = set(versions_info.keys())
+
+        if not versions_info:
+            log.debug(_("No version left for '%s'; skip reading the info file."), name)
+        return versions_info
+
+    async def _read_info(self, name, md5_sum, versions_info, filters):
+        """
+        Download the info file of a gem and build `DeclarativeContent` for the kept versions.
+
+        Args:
+            name (str): The name of the gem.
+            md5_sum (str): The md5 checksum of the info file as listed in the versions file.
+            versions_info (dict): The kept ext_versions as returned by `_filter_versions`. If
+                None, the versions listed in the info file are filtered instead.
+            filters (tuple): The version filters as returned by `_name_filters`.
+
+        Returns:
+            list: The `DeclarativeContent` objects for this gem.
+        """
+        # Interpret policy to download Artifacts or not
+        deferred_download = self.remote.policy != Remote.IMMEDIATE
+        remote_url = self.remote.url
+
+        info_url = urljoin(urljoin(remote_url, "info/"), name)
+        if "md5" in settings.ALLOWED_CONTENT_CHECKSUMS:
+            extra_kwargs = {"expected_digests": {"md5": md5_sum}}
+        elif md5_sum is None:
+            extra_kwargs = {}
+            log.warn(f"Checksum of info file for '{name}' was not provided.")
+        else:
+            extra_kwargs = {}
+            log.warn(f"Checksum of info file for '{name}' could not be validated.")
+        info_downloader = self.remote.get_downloader(url=info_url, **extra_kwargs)
+        info_result = await info_downloader.run()
+        if versions_info is None:
+            ext_versions = await read_info_versions(info_result.path)
+            versions_info = self._filter_versions(name, ext_versions, *filters)
+        dcs = []
+        async for gem_info in read_info(info_result.path, versions_info):
+            gem_info["name"] = name
+            gem_info["version_key"] = ruby_ver_db_key(gem_info["version"])
+            gem = GemContent(**gem_info)
+            gem_path = gem.relative_path
+            gem_url = urljoin(remote_url, gem_path)
+            gemspec_path = gem.gemspec_path
+            gemspec_url = urljoin(remote_url, gemspec_path)
+
+            da_gem = DeclarativeArtifact(
+                artifact=Artifact(sha256=gem_info["checksum"]),
+                url=gem_url,
+                relative_path=gem_path,
+                remote=self.remote,
+                deferred_download=deferred_download,
+            )
+            d_artifacts = [da_gem]
+            # Generated gemspecs are added by the GemspecGenerator stage, or by the content app.
+            if not self.remote.generate_gemspecs:
+                d_artifacts.append(
+                    DeclarativeArtifact(
+                        artifact=Artifact(),
+                        url=gemspec_url,
+                        relative_path=gemspec_path,
+                        remote=self.remote,
+                        deferred_download=deferred_download,
+                    )
+                )
+            dcs.append(DeclarativeContent(content=gem, d_artifacts=d_artifacts))
+        return dcs
+
+    async def _carry_over(self, unchanged_names=None, changed_names=None):
+        """
+        Emit the content of gems with an unchanged info file from the base version.
+
+        Either the unchanged or the changed gem names must be given. The changed ones are few
+        and excluded by the query, while the unchanged ones may list the whole index and are
+        matched as the content is read.
+
+        Args:
+            unchanged_names (set): The names of the gems with an unchanged info file.
+            changed_names (set): The names of the gems with a changed info file.
+        """
+        gems = GemContent.objects.filter(pk__in=self.base_version.content)
+        if changed_names is not None:
+            gems = gems.exclude(name__in=changed_names)
+        # The later stages sort the content by its natural key and only use its pk otherwise.
+        # Loading just these fields spares a query per gem for the deferred ones.
+        gems = gems.only("pk", "name", *GemContent.natural_key_fields())
+        async with ProgressReport(message="Carrying over unchanged gems") as pr_carry_over:
+            async for gem in gems.aiterator():
+                if unchanged_names is None or gem.name in unchanged_names:
+                    await pr_carry_over.aincrement()
+                    await self.put(DeclarativeContent(content=gem))
+
+    async def _put_all(self, dcs, pr_parse_info):
+        """Emit the `DeclarativeContent` of one gem into the pipeline."""
+        for dc in dcs:
+            await pr_parse_info.aincrement()
+            await self.put(dc)
+
+
+class GemspecGenerator(Stage):
+    """
+    Add the gemspec artifacts of the gems, generated from the downloaded gem files.
+
+    This stage must run after the existing content was queried and before the content is saved.
+    The generated artifacts have no remote, so the gemspecs are never downloaded. Content that
+    already exists is left alone, the content app generates its gemspec if it is missing.
+    """
+
+    async def run(self):
+        """Add the gemspec artifact to every new gem that comes with a downloaded gem file only."""
+        async for batch in self.batches():
+            await sync_to_async(self._add_gemspecs)(batch)
+            for dc in batch:
+                await self.put(dc)
+
+    def _add_gemspecs(self, batch):
+        for dc in batch:
+            if not dc.content._state.adding:
+                continue
+            if len(dc.d_artifacts) != 1 or dc.d_artifacts[0].artifact._state.adding:
+                continue
+            da_gem = dc.d_artifacts[0]
+            _gem_info, spec_data = analyse_gem(da_gem.artifact.file)
+            gemspec_path = dc.content.gemspec_path
+            dc.d_artifacts.append(
+                DeclarativeArtifact(
+                    artifact=_artifact_from_data(spec_data),
+                    url=urljoin(da_gem.remote.url, gemspec_path),
+                    relative_path=gemspec_path,
+                )
+            )
+
+
+class GemDeclarativeVersion(DeclarativeVersion):
+    """
+    A DeclarativeVersion that generates the gemspecs if the remote asks for it.
+
+    With a deferred download policy, there is no gem file to generate them from during the sync.
+    """
+
+    def pipeline_stages(self, new_version):
+        """Add the GemspecGenerator stage after the QueryExistingContents stage if needed."""
+        pipeline = super().pipeline_stages(new_version)
+        remote = self.first_stage.remote
+        if remote.generate_gemspecs and remote.policy == Remote.IMMEDIATE:
+            index = next(
+                i for i, stage in enumerate(pipeline) if isinstance(stage, QueryExistingContents)
+            )
+            pipeline.insert(index + 1, GemspecGenerator())
+        return pipeline
@@ -233,7 +233,14 @@ class GemPublicationViewSet(PublicationViewSet, RolesMixin):
         result = dispatch(
             tasks.publish,
             exclusive_resources=[repository_version.repository],
-            kwargs={"repository_version_pk": str(repository_version.pk)},
+            kwargs={
+                "repository_version_pk": str(repository_version.pk),
+                "compact_versions": serializer.validated_data["compact_versions"],
+                "index_formats": serializer.validated_data["index_formats"],
+                "gzip_compact_index": serializer.validated_data["gzip_compact_index"],
+                "html_index": serializer.validated_data["html_index"],
+                "html_index_page_size": serializer.validated_data["html_index_page_size"],
+            },
         )
         return OperationPostponedResponse(result, request)
 
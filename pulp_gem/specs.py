@@ -1,11 +1,13 @@
 import datetime
 import gzip
+import operator
 import re
+import tarfile
 import zlib
 from collections import namedtuple
-from itertools import zip_longest
+from contextlib import ExitStack
+from functools import lru_cache
 from logging import getLogger
-from tarfile import TarFile
 
 import aiofiles
 import rubymarshal.classes
@@ -29,64 +31,100 @@ PRERELEASE_VERSION_REGEX = NAME_REGEX
 GemKey = namedtuple("GemKey", ("name", "version", "platform"))
 
 
-def _ver_tokens(version):
-    numeric = True
-    value = ""
-    for char in version:
-        if char >= "0" and char <= "9":
-            if not numeric:
-                if value:
-                    yield value
-                    value = ""
-                numeric = True
-            value += char
-        elif char == ".":
-            yield value
-            value = ""
-            numeric = True
+VERSION_SEGMENT_REGEX = re.compile(r"[0-9]+|[a-z]+", re.IGNORECASE)
+
+
+@lru_cache(maxsize=65536)
+def ruby_ver_key(version):
+    """
+    Returns a sort key for a version string following the ordering of `Gem::Version`.
+
+    Like RubyGems, the version is split into numeric and string segments and trailing zeros of the
+    release and prerelease part are dropped. Because missing segments compare like zeros, every
+    other segment is encoded together with the number of zeros in front of it. Numbers sort above
+    and strings sort below the terminator, just like they compare to a missing segment.
+    """
+    # https://docs.ruby-lang.org/en/3.3/Gem/Version.html
+    segments = [
+        int(segment) if segment.isdigit() else segment
+        for segment in VERSION_SEGMENT_REGEX.findall(version)
+    ]
+    string_start = next(
+        (i for i, segment in enumerate(segments) if isinstance(segment, str)), len(segments)
+    )
+    key = []
+    for part in (segments[:string_start], segments[string_start:]):
+        while part and part[-1] == 0:
+            part.pop()
+        zeros = 0
+        for segment in part:
+            if segment == 0:
+                zeros += 1
+            elif isinstance(segment, str):
+                key.append((-1, zeros, segment))
+                zeros = 0
+            else:
+                key.append((1, -zeros, segment))
+                zeros = 0
+    key.append((0,))
+    return tuple(key)
+
+
+def ruby_ver_db_key(version):
+    """
+    Returns the `ruby_ver_key` of a version encoded as a string for ordering in the database.
+
+    The string sorts like the key under the "C" collation. Every part of the key starts with a
+    marker that orders strings below the end of the version and numbers above it. Zero counts
+    and number lengths are written with two digits, strings are terminated by "!".
+    """
+    parts = []
+    for part in ruby_ver_key(version):
+        if part[0] < 0:
+            parts.append(f"1{min(part[1], 99):02d}{part[2]}!")
+        elif part[0] > 0:
+            digits = str(part[2])
+            parts.append(f"3{99 + max(part[1], -99):02d}{min(len(digits), 99):02d}{digits}")
         else:
-            if numeric:
-                if value:
-                    yield value
-                    value = ""
-                numeric = False
-            value += char
-    yield value
+            parts.append("2")
+    return "".join(parts)
 
 
 def ruby_ver_cmp(ver1, ver2):
-    # https://docs.ruby-lang.org/en/2.4.0/Gem/Version.html
-    for part1, part2 in zip_longest(_ver_tokens(ver1), _ver_tokens(ver2), fillvalue="0"):
-        try:
-            val1 = [int(part1), ""]
-        except ValueError:
-            val1 = [-1, part1]
-        try:
-            val2 = [int(part2), ""]
-        except ValueError:
-            val2 = [-1, part2]
-        if val1 > val2:
-            return 1
-        if val1 < val2:
-            return -1
-    return 0
+    key1, key2 = ruby_ver_key(ver1), ruby_ver_key(ver2)
+    return (key1 > key2) - (key1 < key2)
 
 
-def ruby_ver_includes(requirements, version):
+_REQUIREMENT_OPS = {
+    "=": operator.eq,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+
+def compile_requirements(requirements):
+    """
+    Compile a requirements string like ">= 1&< 3" into a predicate on version keys.
+
+    The bounds are keyed once, so the predicate can be applied to many versions cheaply. Use
+    `ruby_ver_key` to get the key of a version.
+    """
+    bounds = []
     for requirement in requirements.split("&"):
         op, ver = requirement.split(" ", maxsplit=1)
-        cmp = ruby_ver_cmp(version, ver)
-        if op == "=" and cmp != 0:
-            return False
-        elif op == "<" and cmp != -1:
-            return False
-        elif op == "<=" and cmp == 1:
-            return False
-        elif op == ">" and cmp != 1:
-            return False
-        elif op == ">=" and cmp == -1:
-            return False
-    return True
+        if op in _REQUIREMENT_OPS:
+            bounds.append((_REQUIREMENT_OPS[op], ruby_ver_key(ver)))
+
+    def matches(version_key):
+        return all(accepts(version_key, key) for accepts, key in bounds)
+
+    return matches
+
+
+def ruby_ver_includes(requirements, version):
+    return compile_requirements(requirements)(ruby_ver_key(version))
 
 
 def split_ext_version(ext_version):
@@ -99,13 +137,18 @@ def split_ext_version(ext_version):
     return {"version": version, "platform": platform, "prerelease": prerelease}
 
 
-async def read_versions(relative_path):
+async def _read_versions_lines(relative_path, offset):
+    """
+    Emit the stripped gem lines of the versions file.
+    """
     # File starts with:
     #   created_at: <timestamp>
     #   ---
     async with aiofiles.open(relative_path, mode="r") as fp:
-        results = {}
         preamble = True
+        if offset:
+            await fp.seek(offset)
+            preamble = False
         async for line in fp:
             line = line.strip()
             if line == "---":
@@ -113,19 +156,73 @@ async def read_versions(relative_path):
                 continue
             if preamble:
                 continue
-            # Dirty trick to make the md5sum default to None
-            split_line = line.split(" ", maxsplit=2) + [None]
-            name = split_line[0]
-            versions_str = split_line[1]
-            md5_sum = split_line[2]
-            ext_versions = versions_str.split(",")
-            entry = results.get(name) or ([], "")
-            results[name] = (entry[0] + ext_versions, md5_sum)
-    for name, (ext_versions, md5_sum) in results.items():
-        # Sanitize name
-        if not NAME_REGEX.fullmatch(name):
-            raise InvalidGemNameError(name=name)
-        yield name, ext_versions, md5_sum
+            if not line:
+                continue
+            yield line
+
+
+async def read_versions(relative_path, offset=0):
+    """
+    Emit (name, ext_versions, md5_sum) entries from the versions file.
+
+    A gem is listed again whenever it changes, so its entry is emitted at its last line, carrying
+    the versions of all its lines and the md5 sum of the last one. Versions prefixed with "-" were
+    yanked and are removed from the entry. The file is read twice: first
+    to find the last line of every gem, then to merge and emit the entries. Only the versions of
+    gems whose last line is still ahead are held in memory.
+
+    Args:
+        relative_path (str): The path of the versions file.
+        offset (int): The byte offset to start reading at. The part of the file after a nonzero
+            offset is expected to contain only gem lines.
+    """
+    last_lines = {}
+    index = 0
+    async for line in _read_versions_lines(relative_path, offset):
+        name = line.split(" ", maxsplit=1)[0]
+        if name not in last_lines:
+            # Sanitize name
+            if not NAME_REGEX.fullmatch(name):
+                raise InvalidGemNameError(name=name)
+        last_lines[name] = index
+        index += 1
+
+    pending = {}
+    index = 0
+    async for line in _read_versions_lines(relative_path, offset):
+        # Dirty trick to make the md5sum default to None
+        name, versions_str, md5_sum = (line.split(" ", maxsplit=2) + [None])[:3]
+        ext_versions = pending.pop(name, [])
+        for ext_version in versions_str.split(","):
+            if ext_version.startswith("-"):
+                # The version was yanked.
+                if ext_version[1:] in ext_versions:
+                    ext_versions.remove(ext_version[1:])
+            elif ext_version:
+                ext_versions.append(ext_version)
+        if last_lines[name] != index:
+            pending[name] = ext_versions
+        else:
+            yield name, ext_versions, md5_sum
+        index += 1
+
+
+async def read_info_versions(relative_path):
+    """
+    Return the ext_versions listed in the info file.
+    """
+    ext_versions = []
+    async with aiofiles.open(relative_path, mode="r") as fp:
+        preamble = True
+        async for line in fp:
+            line = line.strip()
+            if line == "---":
+                preamble = False
+                continue
+            if preamble:
+                continue
+            ext_versions.append(line.split(" ", maxsplit=1)[0])
+    return ext_versions
 
 
 async def read_info(relative_path, versions_info):
@@ -346,10 +443,22 @@ rubymarshal.classes.registry.register(GemDependency)
 rubymarshal.classes.registry.register(RubyTime)
 
 
-class RubyMarshalYamlLoader(yaml.SafeLoader):
+class PyRubyMarshalYamlLoader(yaml.SafeLoader):
     pass
 
 
+if hasattr(yaml, "CSafeLoader"):
+
+    class CRubyMarshalYamlLoader(yaml.CSafeLoader):
+        pass
+
+    # The LibYAML parser is a lot faster, but it is not available on every installation.
+    RubyMarshalYamlLoader = CRubyMarshalYamlLoader
+else:
+    CRubyMarshalYamlLoader = None
+    RubyMarshalYamlLoader = PyRubyMarshalYamlLoader
+
+
 def _yaml_ruby_constructor(loader, suffix, node):
     try:
         return rubymarshal.classes.registry[suffix].yaml_constructor(loader, node)
@@ -357,17 +466,104 @@ def _yaml_ruby_constructor(loader, suffix, node):
         raise UnknownRubyClassError(suffix=suffix)
 
 
-yaml.add_multi_constructor("!ruby/object:", _yaml_ruby_constructor, Loader=RubyMarshalYamlLoader)
+yaml.add_multi_constructor("!ruby/object:", _yaml_ruby_constructor, Loader=PyRubyMarshalYamlLoader)
+if CRubyMarshalYamlLoader is not None:
+    yaml.add_multi_constructor(
+        "!ruby/object:", _yaml_ruby_constructor, Loader=CRubyMarshalYamlLoader
+    )
+
 
+def _marshal_long(value):
+    """Encode a non-negative integer the way Marshal writes lengths and indices."""
+    if value == 0:
+        return b"\x00"
+    if value < 123:
+        return bytes((value + 5,))
+    size = (value.bit_length() + 7) // 8
+    return bytes((size,)) + value.to_bytes(size, "little")
 
-def write_specs(gem_keys, relative_path):
+
+class _TeeWriter:
+    """A minimal file object that writes the same bytes to several file objects."""
+
+    def __init__(self, *fds):
+        self.fds = fds
+
+    def write(self, data):
+        for fd in self.fds:
+            fd.write(data)
+
+
+def write_specs(gem_keys, relative_path, count=None, gzip_level=None):
     """
     Write rubygem specs to file.
+
+    If `gzip_level` is given, a gzip compressed copy is written to `relative_path` + ".gz" at the
+    same time with that compression level. It carries no timestamp, so it is reproducible.
+
+    The specs are a Marshal 4.8 encoded array of [name, Gem::Version, platform] entries. Entries
+    are encoded one at a time as they come, so `gem_keys` can be a database cursor if the number
+    of entries is given as `count`. Otherwise it is collected first to count it.
+
+    Like Ruby, every symbol is written once and referenced by index afterwards. The entries do not
+    share any objects, so no object links are needed.
+    """
+    if count is None:
+        gem_keys = list(gem_keys)
+        count = len(gem_keys)
+    symbols = {}
+
+    def symbol(name):
+        if (index := symbols.get(name)) is not None:
+            return b";" + _marshal_long(index)
+        symbols[name] = len(symbols)
+        encoded = name.encode()
+        return b":" + _marshal_long(len(encoded)) + encoded
+
+    def string(value):
+        encoded = value.encode()
+        # A String with one instance variable, E = true, that marks it as UTF-8.
+        return b'I"' + _marshal_long(len(encoded)) + encoded + b"\x06" + symbol("E") + b"T"
+
+    written = 0
+    with ExitStack() as stack:
+        fd = stack.enter_context(open(relative_path, "wb"))
+        if gzip_level is not None:
+            # Without a timestamp, identical specs give identical gzip files.
+            gz_fd = stack.enter_context(
+                gzip.GzipFile(str(relative_path) + ".gz", "wb", compresslevel=gzip_level, mtime=0)
+            )
+            fd = _TeeWriter(fd, gz_fd)
+        fd.write(b"\x04\x08[" + _marshal_long(count))
+        for name, version, platform in gem_keys:
+            fd.write(
+                b"[\x08"
+                + string(name)
+                + b"U"
+                + symbol(GemVersion.ruby_class_name)
+                + b"[\x06"
+                + string(version)
+                + string(platform)
+            )
+            written += 1
+    if written != count:
+        raise ValueError(f"Expected {count} specs, but got {written}.")
+
+
+def read_gem_metadata(file_obj):
+    """
+    Return the gzip compressed gemspec YAML of a gem file.
+
+    The tar headers are read one after the other and reading stops right after `metadata.gz`,
+    which gem builds put first. Unlike looking the member up by name, this does not scan the
+    headers of the whole archive, and the file object does not need to be seekable.
     """
-    specs = [[e.name, GemVersion(e.version), e.platform] for e in gem_keys]
-    # write uncompressed version
-    with open(relative_path, "wb") as fd:
-        rubymarshal.writer.write(fd, specs)
+    with tarfile.open(fileobj=file_obj, mode="r|") as archive:
+        for member in archive:
+            if member.name == "metadata.gz":
+                with archive.extractfile(member) as md_file:
+                    return md_file.read()
+    raise KeyError("filename 'metadata.gz' not found")
 
 
 def analyse_gem(file_obj):
@@ -376,14 +572,13 @@ def analyse_gem(file_obj):
 
     The resulting gem_info is missing the checksum field.
     """
-    with TarFile(fileobj=file_obj) as archive:
-        with archive.extractfile("metadata.gz") as md_file:
-            data = yaml.load(gzip.decompress(md_file.read()), Loader=RubyMarshalYamlLoader)
+    data = yaml.load(gzip.decompress(read_gem_metadata(file_obj)), Loader=RubyMarshalYamlLoader)
     gem_info = {
         "name": data._private_data["name"],
         "version": data._private_data["version"].version,
         "platform": data.platform,
     }
+    gem_info["version_key"] = ruby_ver_db_key(gem_info["version"])
     # Sanitize name
     if not NAME_REGEX.fullmatch(gem_info["name"]):
         raise InvalidGemNameError(name=gem_info["name"])
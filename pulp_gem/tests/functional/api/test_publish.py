@@ -1,9 +1,17 @@
 """Tests that publish gem plugin repositories."""
 
+import asyncio
+import base64
+import gzip
+import hashlib
 from random import choice
+from urllib.parse import urljoin
 
+import aiohttp
 import pytest
 
+from pulpcore.client.pulp_gem import ApiException
+
 
 @pytest.mark.parallel
 def test_publish(
@@ -58,3 +66,110 @@ def test_publish(
 
     # Step 5
     assert publication.repository_version == non_latest
+
+
+def _redirects_to_object_storage(pulp_settings):
+    return (
+        pulp_settings.STORAGES["default"]["BACKEND"] != "pulpcore.app.models.storage.FileSystem"
+        and pulp_settings.REDIRECT_TO_OBJECT_STORAGE
+    )
+
+
+def _get(url, headers):
+    """Fetch a url as is, without decompressing the body."""
+
+    async def _send_request():
+        async with aiohttp.ClientSession(auto_decompress=False) as session:
+            async with session.get(url, headers=headers) as response:
+                return response.status, response.headers, await response.read()
+
+    return asyncio.run(_send_request())
+
+
+@pytest.mark.parallel
+def test_publish_gzip_compact_index(
+    gem_bindings,
+    gem_publication_factory,
+    gem_remote_factory,
+    gem_repository_factory,
+    gem_distribution_factory,
+    distribution_base_url,
+    pulp_settings,
+    monitor_task,
+):
+    """Test that the gzip compressed variants of the compact index files are served."""
+    repository = gem_repository_factory()
+    remote = gem_remote_factory()
+    result = gem_bindings.RepositoriesGemApi.sync(
+        repository.pulp_href, {"remote": remote.pulp_href}
+    )
+    monitor_task(result.task)
+    if pulp_settings.CACHE_ENABLED or _redirects_to_object_storage(pulp_settings):
+        # The variants could never be served, so they are not published.
+        with pytest.raises(ApiException) as exc:
+            gem_publication_factory(repository=repository.pulp_href, gzip_compact_index=True)
+        assert exc.value.status == 400
+        return
+    publication = gem_publication_factory(repository=repository.pulp_href, gzip_compact_index=True)
+    assert publication.gzip_compact_index is True
+    distribution = gem_distribution_factory(publication=publication.pulp_href)
+    base_url = distribution_base_url(distribution.base_url)
+
+    for path in ("names", "versions", "info/amber"):
+        url = urljoin(base_url, path)
+        status, headers, plain = _get(url, {"Accept-Encoding": "identity"})
+        assert status == 200
+        assert "Content-Encoding" not in headers
+        assert headers["Vary"] == "Accept-Encoding"
+        status, headers, compressed = _get(url, {"Accept-Encoding": "gzip"})
+        assert status == 200
+        assert headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(compressed) == plain
+
+    # Ranges are served from the uncompressed file.
+    url = urljoin(base_url, "versions")
+    _status, _headers, plain = _get(url, {"Accept-Encoding": "identity"})
+    status, headers, partial = _get(url, {"Accept-Encoding": "gzip", "Range": "bytes=0-9"})
+    assert status == 206
+    assert "Content-Encoding" not in headers
+    assert partial == plain[:10]
+
+
+@pytest.mark.parallel
+def test_compact_index_conditional_requests(
+    gem_bindings,
+    gem_publication_factory,
+    gem_remote_factory,
+    gem_repository_factory,
+    gem_distribution_factory,
+    distribution_base_url,
+    pulp_settings,
+    monitor_task,
+):
+    """Test that the compact index files carry their digests and answer If-None-Match."""
+    if _redirects_to_object_storage(pulp_settings):
+        pytest.skip("Clients are redirected to the object storage.")
+    repository = gem_repository_factory()
+    remote = gem_remote_factory()
+    result = gem_bindings.RepositoriesGemApi.sync(
+        repository.pulp_href, {"remote": remote.pulp_href}
+    )
+    monitor_task(result.task)
+    publication = gem_publication_factory(repository=repository.pulp_href)
+    distribution = gem_distribution_factory(publication=publication.pulp_href)
+    base_url = distribution_base_url(distribution.base_url)
+
+    for path in ("names", "versions", "info/amber"):
+        url = urljoin(base_url, path)
+        status, headers, body = _get(url, {})
+        assert status == 200
+        digest = base64.b64encode(hashlib.sha256(body).digest()).decode()
+        assert headers["Repr-Digest"] == f"sha-256=:{digest}:"
+        assert headers["ETag"].startswith('"')
+        # Twice, to get the response from the content cache as well if it is enabled.
+        for _attempt in range(2):
+            status, headers, body = _get(url, {"If-None-Match": headers["ETag"]})
+            assert status == 304
+            assert body == b""
+        status, headers, body = _get(url, {"If-None-Match": '"outdated"'})
+        assert status == 200
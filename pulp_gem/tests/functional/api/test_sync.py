@@ -1,9 +1,13 @@
 """Tests that sync gem plugin repositories."""
 
+import io
+from urllib.parse import urljoin
+
 import pytest
 
 from pulpcore.tests.functional.utils import PulpTaskError
 
+from pulp_gem.specs import analyse_gem
 from pulp_gem.tests.functional.constants import (
     DOWNLOAD_POLICIES,
     GEM_FIXTURE_SUMMARY,
@@ -75,6 +79,23 @@ def test_download_policies(
     assert repo2.latest_version_href == repo.latest_version_href
 
 
+@pytest.mark.parallel
+def test_resync_unchanged(gem_bindings, gem_remote_factory, gem_repository_factory, monitor_task):
+    """Sync again, and check that the unchanged versions file stops the sync early."""
+    remote = gem_remote_factory(url=GEM_FIXTURE_URL, policy="on_demand")
+    repo = gem_repository_factory(remote=remote.pulp_href)
+    monitor_task(gem_bindings.RepositoriesGemApi.sync(repo.pulp_href, {}).task)
+    repo = gem_bindings.RepositoriesGemApi.read(repo.pulp_href)
+    assert repo.latest_version_href.endswith("/1/")
+
+    task = monitor_task(gem_bindings.RepositoriesGemApi.sync(repo.pulp_href, {}).task)
+    repo2 = gem_bindings.RepositoriesGemApi.read(repo.pulp_href)
+    assert repo2.latest_version_href == repo.latest_version_href
+    assert task.created_resources == []
+    # Only the versions file was fetched, no pipeline ran.
+    assert [report.message for report in task.progress_reports] == ["Downloading versions list"]
+
+
 @pytest.mark.parallel
 def test_invalid_url(do_sync):
     """Sync a repository using a remote url that does not exist."""
@@ -96,3 +117,68 @@ def test_invalid_plugin_template_content(do_sync):
     with pytest.raises(PulpTaskError) as exc:
         do_sync(url=GEM_INVALID_FIXTURE_URL)
     assert "Some invalid message" in exc.value.task.to_dict()["error"]["description"]
+
+
+@pytest.mark.parallel
+@pytest.mark.parametrize("download_policy", DOWNLOAD_POLICIES)
+def test_generate_gemspecs(
+    gem_bindings,
+    download_policy,
+    do_sync,
+    gem_remote_factory,
+    gem_publication_factory,
+    gem_distribution_factory,
+    download_content_unit,
+    http_get,
+):
+    """Sync a remote that generates the gemspecs and fetch one from the distribution."""
+    remote = gem_remote_factory(policy=download_policy, generate_gemspecs=True)
+    assert remote.generate_gemspecs is True
+    repo, _ = do_sync(remote=remote)
+    publication = gem_publication_factory(repository=repo.pulp_href)
+    distribution = gem_distribution_factory(publication=publication.pulp_href)
+
+    content = gem_bindings.ContentGemApi.list(repository_version=repo.latest_version_href)
+    gem = content.results[0]
+    ext_version = gem.version if gem.platform == "ruby" else f"{gem.version}-{gem.platform}"
+    gem_data = http_get(urljoin(GEM_FIXTURE_URL, f"gems/{gem.name}-{ext_version}.gem"))
+    _gem_info, spec_data = analyse_gem(io.BytesIO(gem_data))
+    gemspec_path = f"quick/Marshal.4.8/{gem.name}-{ext_version}.gemspec.rz"
+    gemspec = download_content_unit(distribution.base_path, gemspec_path)
+    assert gemspec == spec_data
+
+    # The gem downloaded to generate the gemspec is kept, unless the remote is streamed.
+    gem = gem_bindings.ContentGemApi.read(gem.pulp_href)
+    stored = download_policy != "streamed"
+    assert (gem.artifacts[f"gems/{gem.name}-{ext_version}.gem"] is not None) == stored
+    assert (gem.artifacts.get(gemspec_path) is not None) == stored
+
+
+@pytest.mark.parallel
+def test_generate_gemspecs_from_stored_gems(
+    gem_bindings,
+    do_sync,
+    gem_remote_factory,
+    gem_publication_factory,
+    gem_distribution_factory,
+    download_content_unit,
+):
+    """Fetch the gem of an on_demand sync, and check that its generated gemspec gets stored."""
+    remote = gem_remote_factory(policy="on_demand", generate_gemspecs=True)
+    repo, _ = do_sync(remote=remote)
+    publication = gem_publication_factory(repository=repo.pulp_href)
+    distribution = gem_distribution_factory(publication=publication.pulp_href)
+
+    content = gem_bindings.ContentGemApi.list(repository_version=repo.latest_version_href)
+    gem = content.results[0]
+    ext_version = gem.version if gem.platform == "ruby" else f"{gem.version}-{gem.platform}"
+    gemspec_path = f"quick/Marshal.4.8/{gem.name}-{ext_version}.gemspec.rz"
+    gem_data = download_content_unit(distribution.base_path, f"gems/{gem.name}-{ext_version}.gem")
+    _gem_info, spec_data = analyse_gem(io.BytesIO(gem_data))
+    assert gemspec_path not in gem.artifacts
+
+    assert download_content_unit(distribution.base_path, gemspec_path) == spec_data
+    gem = gem_bindings.ContentGemApi.read(gem.pulp_href)
+    assert gem.artifacts[gemspec_path] is not None
+    # Now served from the stored artifact.
+    assert download_content_unit(distribution.base_path, gemspec_path) == spec_data
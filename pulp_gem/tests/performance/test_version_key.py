@@ -0,0 +1,86 @@
+import random
+import timeit
+from functools import cmp_to_key
+from itertools import zip_longest
+
+from pulp_gem.specs import ruby_ver_cmp, ruby_ver_key
+
+
+def _legacy_ver_tokens(version):
+    numeric = True
+    value = ""
+    for char in version:
+        if char >= "0" and char <= "9":
+            if not numeric:
+                if value:
+                    yield value
+                    value = ""
+                numeric = True
+            value += char
+        elif char == ".":
+            yield value
+            value = ""
+            numeric = True
+        else:
+            if numeric:
+                if value:
+                    yield value
+                    value = ""
+                numeric = False
+            value += char
+    yield value
+
+
+def _legacy_ver_cmp(ver1, ver2):
+    # The pairwise comparison used before version keys were introduced.
+    tokens1, tokens2 = _legacy_ver_tokens(ver1), _legacy_ver_tokens(ver2)
+    for part1, part2 in zip_longest(tokens1, tokens2, fillvalue="0"):
+        try:
+            val1 = [int(part1), ""]
+        except ValueError:
+            val1 = [-1, part1]
+        try:
+            val2 = [int(part2), ""]
+        except ValueError:
+            val2 = [-1, part2]
+        if val1 > val2:
+            return 1
+        if val1 < val2:
+            return -1
+    return 0
+
+
+def _version_corpus(size=20000):
+    """Version strings shaped like the ones found on rubygems.org."""
+    rng = random.Random(4711)
+    versions = []
+    for _ in range(size):
+        version = ".".join(
+            str(rng.choice((0, 0, 1, 2, 3, 10, 12, 2024)))
+            for _ in range(rng.choice((1, 2, 3, 3, 4)))
+        )
+        if rng.random() < 0.15:
+            version += rng.choice((".pre", ".rc", ".beta", ".alpha", "a", "rc")) + str(
+                rng.randint(0, 3)
+            )
+        versions.append(version)
+    return versions
+
+
+def test_version_key_sort_speedup():
+    versions = _version_corpus()
+    assert sorted(versions, key=ruby_ver_key) == sorted(versions, key=cmp_to_key(ruby_ver_cmp))
+
+    def sort_legacy():
+        sorted(versions, key=cmp_to_key(_legacy_ver_cmp))
+
+    def sort_key():
+        ruby_ver_key.cache_clear()
+        sorted(versions, key=ruby_ver_key)
+
+    legacy = min(timeit.repeat(sort_legacy, number=1, repeat=3))
+    keyed = min(timeit.repeat(sort_key, number=1, repeat=3))
+    print(
+        f"Sorting {len(versions)} versions: pairwise cmp {legacy:.3f}s, "
+        f"sort key {keyed:.3f}s, speedup {legacy / keyed:.1f}x"
+    )
@@ -0,0 +1,199 @@
+import asyncio
+import gzip
+import hashlib
+import uuid
+from unittest import mock
+
+import pytest
+
+from pulpcore.plugin.models import PublishedArtifact
+
+from pulp_gem.app.models import GemContent, GemPublication, GemRepository
+from pulp_gem.app.tasks import publishing
+from pulp_gem.app.tasks.publishing import EMPTY_INFO_MD5, publish
+from pulp_gem.specs import read_versions, ruby_ver_db_key
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def repository():
+    return GemRepository.objects.create(name=f"repo-{uuid.uuid4().hex[:8]}")
+
+
+@pytest.fixture
+def gem_factory():
+    def _gem_factory(name, version):
+        return GemContent.objects.create(
+            name=name,
+            version=version,
+            version_key=ruby_ver_db_key(version),
+            platform="ruby",
+            checksum=hashlib.sha256(f"{name}-{version}-{uuid.uuid4()}".encode()).hexdigest(),
+        )
+
+    return _gem_factory
+
+
+@pytest.fixture
+def do_publish(tmp_path_factory, monkeypatch):
+    """Publish a repository version in a fresh working directory, returning the publication."""
+
+    def _do_publish(repository_version, **kwargs):
+        monkeypatch.chdir(tmp_path_factory.mktemp("publish"))
+        # CreatedResource requires a current task, which unit tests do not have.
+        with mock.patch("pulpcore.app.models.publication.CreatedResource"):
+            publish(repository_version.pk, **kwargs)
+        return GemPublication.objects.filter(repository_version=repository_version).latest(
+            "pulp_created"
+        )
+
+    return _do_publish
+
+
+def _new_version(repository, add=(), remove=()):
+    with repository.new_version() as repository_version:
+        if add:
+            repository_version.add_content(GemContent.objects.filter(pk__in=[c.pk for c in add]))
+        if remove:
+            repository_version.remove_content(
+                GemContent.objects.filter(pk__in=[c.pk for c in remove])
+            )
+    return repository_version
+
+
+def _published_artifact(publication, relative_path):
+    return (
+        PublishedArtifact.objects.select_related("content_artifact__artifact")
+        .get(publication=publication, relative_path=relative_path)
+        .content_artifact.artifact
+    )
+
+
+def _published_file(publication, relative_path):
+    with _published_artifact(publication, relative_path).file.open("rb") as fp:
+        return fp.read()
+
+
+def _md5(publication, relative_path):
+    return hashlib.md5(_published_file(publication, relative_path)).hexdigest()
+
+
+def _names(call):
+    """The names of the gems whose info files were written by a `_publish_info_files` call."""
+    return set(call.args[0].values_list("name", flat=True))
+
+
+def test_publish_appends_to_versions(repository, gem_factory, do_publish):
+    amber_1 = gem_factory("amber", "1.0.0")
+    amber_2 = gem_factory("amber", "1.1.0")
+    panda = gem_factory("panda", "0.1.0")
+    zebra_1 = gem_factory("zebra", "2.0")
+    zebra_2 = gem_factory("zebra", "2.1")
+    ant = gem_factory("ant", "1.0")
+    version_1 = _new_version(repository, add=[amber_1, amber_2, panda, zebra_1])
+    publication = do_publish(version_1)
+    previous_versions = _published_file(publication, "versions")
+    assert previous_versions.decode().splitlines()[1:] == [
+        "---",
+        f"amber 1.0.0,1.1.0 {_md5(publication, 'info/amber')}",
+        f"panda 0.1.0 {_md5(publication, 'info/panda')}",
+        f"zebra 2.0 {_md5(publication, 'info/zebra')}",
+    ]
+
+    version_2 = _new_version(repository, add=[zebra_2, ant], remove=[amber_2, panda])
+    publication = do_publish(version_2)
+    versions = _published_file(publication, "versions")
+    assert versions.startswith(previous_versions)
+    assert versions[len(previous_versions) :].decode().splitlines() == [
+        f"amber -1.1.0 {_md5(publication, 'info/amber')}",
+        f"ant 1.0 {_md5(publication, 'info/ant')}",
+        f"zebra 2.1 {_md5(publication, 'info/zebra')}",
+        # The gem is gone entirely, its info file would be empty.
+        f"panda -0.1.0 {EMPTY_INFO_MD5}",
+    ]
+    assert _published_file(publication, "versions.list") == versions
+
+    publication = do_publish(version_2, compact_versions=True)
+    versions = _published_file(publication, "versions").decode()
+    assert versions.startswith("created_at: ")
+    assert versions.splitlines()[1:] == [
+        "---",
+        f"amber 1.0.0 {_md5(publication, 'info/amber')}",
+        f"ant 1.0 {_md5(publication, 'info/ant')}",
+        f"zebra 2.0,2.1 {_md5(publication, 'info/zebra')}",
+    ]
+
+
+def test_publish_appends_info_only_changes(repository, gem_factory, do_publish, tmp_path):
+    amber = gem_factory("amber", "1.0.0")
+    version_1 = _new_version(repository, add=[amber, gem_factory("amber", "1.1.0")])
+    previous_versions = _published_file(do_publish(version_1), "versions")
+
+    # The gem is replaced under the same version, so only its info file checksum changes.
+    version_2 = _new_version(repository, add=[gem_factory("amber", "1.0.0")], remove=[amber])
+    publication = do_publish(version_2)
+    versions = _published_file(publication, "versions")
+    assert versions[len(previous_versions) :].decode().splitlines() == [
+        f"amber -1.1.0,1.1.0 {_md5(publication, 'info/amber')}"
+    ]
+
+    async def _read_versions(path):
+        return [line async for line in read_versions(path)]
+
+    versions_path = tmp_path / "versions"
+    versions_path.write_bytes(versions)
+    assert asyncio.run(_read_versions(str(versions_path))) == [
+        ("amber", ["1.0.0", "1.1.0"], _md5(publication, "info/amber"))
+    ]
+
+
+def test_publish_reuses_info_files(repository, gem_factory, do_publish):
+    amber_1 = gem_factory("amber", "1.0.0")
+    amber_2 = gem_factory("amber", "1.1.0")
+    panda = gem_factory("panda", "0.1.0")
+    zebra = gem_factory("zebra", "2.0")
+    version_1 = _new_version(repository, add=[amber_1, panda])
+    previous_publication = do_publish(version_1)
+
+    version_2 = _new_version(repository, add=[amber_2])
+    with mock.patch.object(
+        publishing, "_publish_info_files", wraps=publishing._publish_info_files
+    ) as publish_info_files:
+        publication = do_publish(version_2)
+    written = {name for call in publish_info_files.call_args_list for name in _names(call)}
+    assert written == {"amber"}
+    assert (
+        _published_artifact(publication, "info/panda").pk
+        == _published_artifact(previous_publication, "info/panda").pk
+    )
+    assert (
+        _published_artifact(publication, "info/amber").pk
+        != _published_artifact(previous_publication, "info/amber").pk
+    )
+
+    # The previous publication has no gzip variants to reuse, so they are all written.
+    with mock.patch.object(
+        publishing, "_publish_info_files", wraps=publishing._publish_info_files
+    ) as publish_info_files:
+        previous_publication = do_publish(version_2, gzip_compact_index=True)
+    written = {name for call in publish_info_files.call_args_list for name in _names(call)}
+    assert written == {"amber", "panda"}
+    for name in ("amber", "panda"):
+        assert gzip.decompress(
+            _published_file(previous_publication, f"gzip/info/{name}")
+        ) == _published_file(previous_publication, f"info/{name}")
+
+    # Now the gzip variants are reused along with the info files.
+    version_3 = _new_version(repository, add=[zebra])
+    with mock.patch.object(
+        publishing, "_publish_info_files", wraps=publishing._publish_info_files
+    ) as publish_info_files:
+        publication = do_publish(version_3, gzip_compact_index=True)
+    written = {name for call in publish_info_files.call_args_list for name in _names(call)}
+    assert written == {"zebra"}
+    for relative_path in ("info/amber", "gzip/info/amber", "info/panda", "gzip/info/panda"):
+        assert (
+            _published_artifact(publication, relative_path).pk
+            == _published_artifact(previous_publication, relative_path).pk
+        )
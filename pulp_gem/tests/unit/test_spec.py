@@ -1,4 +1,30 @@
-from pulp_gem.specs import ruby_ver_cmp, ruby_ver_includes
+import asyncio
+import gzip
+import importlib
+import io
+import os
+import tarfile
+import zlib
+
+import pytest
+import rubymarshal.reader
+import rubymarshal.writer
+import yaml
+
+from pulp_gem.specs import (
+    CRubyMarshalYamlLoader,
+    GemVersion,
+    PyRubyMarshalYamlLoader,
+    analyse_gem,
+    compile_requirements,
+    read_info_versions,
+    read_versions,
+    ruby_ver_cmp,
+    ruby_ver_db_key,
+    ruby_ver_includes,
+    ruby_ver_key,
+    write_specs,
+)
 
 
 def test_version_cmp():
@@ -13,6 +39,38 @@ def test_version_cmp():
     assert ruby_ver_cmp("1.0b1", "1.0.a.2") == 1
 
 
+def test_version_key():
+    assert ruby_ver_key("1.0.a") == ruby_ver_key("1.a")
+    assert ruby_ver_key("1.a.0") == ruby_ver_key("1.a")
+    versions = ["1.0", "1.0.b1", "0.9", "1.0.a", "1.0.0.1", "1.0.a.10", "1.0.a.2", "1.0.rc1"]
+    assert sorted(versions, key=ruby_ver_key) == [
+        "0.9",
+        "1.0.a",
+        "1.0.a.2",
+        "1.0.a.10",
+        "1.0.b1",
+        "1.0.rc1",
+        "1.0",
+        "1.0.0.1",
+    ]
+
+
+def test_version_db_key():
+    versions = ["1.0", "1.0.b1", "0.9", "1.0.a", "1.0.0.1", "1.0.a.10", "1.0.a.2", "10", "1.0.0"]
+    assert sorted(versions, key=lambda v: ruby_ver_db_key(v).encode()) == sorted(
+        versions, key=ruby_ver_key
+    )
+    assert ruby_ver_db_key("1.0.0") == ruby_ver_db_key("1")
+
+
+def test_version_db_key_migration():
+    # The stored keys were computed by the migration, a changed key needs a new one to update them.
+    migration = importlib.import_module("pulp_gem.app.migrations.0014_gemcontent_version_key")
+    versions = ["1.0", "1.0.b1", "0.9", "1.0.a", "1.0.0.1", "1.0.a.10", "0.0.1", "10", "1.0.0-x"]
+    for version in versions:
+        assert migration.ruby_ver_db_key(version) == ruby_ver_db_key(version)
+
+
 def test_version_includes():
     assert ruby_ver_includes(">= 1&< 3", "1.0.0")
     assert ruby_ver_includes(">= 1&< 3", "2.0.0")
@@ -20,3 +78,228 @@ def test_version_includes():
     assert ruby_ver_includes(">= 1&< 3", "1.5.a0")
     assert ruby_ver_includes(">= 1&< 3", "3.0.0a5")
     assert not ruby_ver_includes(">= 1&< 3", "3.0.1a5")
+
+
+def test_compile_requirements():
+    matches = compile_requirements(">= 1&< 3")
+    for version in ("1.0.0", "2.0.0", "3.0.0", "1.5.a0", "3.0.0a5", "3.0.1a5", "0.9"):
+        assert matches(ruby_ver_key(version)) == ruby_ver_includes(">= 1&< 3", version)
+    assert compile_requirements("= 1.0")(ruby_ver_key("1"))
+    assert not compile_requirements("> 1.0")(ruby_ver_key("1.0.0"))
+
+
+VERSIONS_FILE = """created_at: 2024-01-01T00:00:00Z
+---
+amber 1.0.0,1.1.0 0123456789abcdef0123456789abcdef
+panda 0.1.0 fedcba9876543210fedcba9876543210
+"""
+APPENDED_LINES = "amber 1.2.0 00000000000000000000000000000000\n"
+
+
+async def _collect(aiterable):
+    return [item async for item in aiterable]
+
+
+def test_read_versions(tmp_path):
+    path = tmp_path / "versions"
+    path.write_text(VERSIONS_FILE + APPENDED_LINES)
+    assert asyncio.run(_collect(read_versions(path))) == [
+        ("panda", ["0.1.0"], "fedcba9876543210fedcba9876543210"),
+        ("amber", ["1.0.0", "1.1.0", "1.2.0"], "00000000000000000000000000000000"),
+    ]
+
+
+def test_read_versions_merges_interleaved_lines(tmp_path):
+    path = tmp_path / "versions"
+    path.write_text(
+        "created_at: 2024-01-01T00:00:00Z\n---\n"
+        "amber 1.0.0 aaa\npanda 0.1.0 bbb\namber 1.1.0 ccc\n"
+        "zebra 2.0 ddd\npanda 0.2.0 eee\namber 1.2.0 fff\n"
+    )
+    assert asyncio.run(_collect(read_versions(path))) == [
+        ("zebra", ["2.0"], "ddd"),
+        ("panda", ["0.1.0", "0.2.0"], "eee"),
+        ("amber", ["1.0.0", "1.1.0", "1.2.0"], "fff"),
+    ]
+
+
+def test_read_versions_yanked(tmp_path):
+    path = tmp_path / "versions"
+    path.write_text(
+        "created_at: 2024-01-01T00:00:00Z\n---\n"
+        "amber 1.0.0,1.1.0 aaa\npanda 0.1.0 bbb\namber 1.2.0,-1.1.0 ccc\npanda -0.1.0 ddd\n"
+    )
+    assert asyncio.run(_collect(read_versions(path))) == [
+        ("amber", ["1.0.0", "1.2.0"], "ccc"),
+        ("panda", [], "ddd"),
+    ]
+
+
+def test_read_versions_offset(tmp_path):
+    path = tmp_path / "versions"
+    path.write_text(VERSIONS_FILE + APPENDED_LINES)
+    assert asyncio.run(_collect(read_versions(path, offset=len(VERSIONS_FILE)))) == [
+        ("amber", ["1.2.0"], "00000000000000000000000000000000"),
+    ]
+
+
+def test_read_info_versions(tmp_path):
+    path = tmp_path / "amber"
+    path.write_text("---\n1.0.0 |checksum:abc\n1.1.0-java dep:>= 1|checksum:def,ruby:>= 2.7\n")
+    assert asyncio.run(read_info_versions(path)) == ["1.0.0", "1.1.0-java"]
+
+
+@pytest.mark.parametrize("count", [0, 1, 122, 123, 300])
+def test_write_specs(tmp_path, count):
+    gem_keys = [(f"gem-{i}-ü", f"1.{i}.0", "ruby" if i % 2 else "java") for i in range(count)]
+    write_specs(iter(gem_keys), tmp_path / "specs", count=count)
+    expected = []
+    for name, version, platform in gem_keys:
+        gem_version = GemVersion()
+        gem_version.marshal_load([version])
+        expected.append([name, gem_version, platform])
+    data = (tmp_path / "specs").read_bytes()
+    assert data == rubymarshal.writer.writes(expected)
+    assert [
+        [name, gem_version.version, platform]
+        for name, gem_version, platform in rubymarshal.reader.loads(data)
+    ] == [list(gem_key) for gem_key in gem_keys]
+
+
+def test_write_specs_gzip(tmp_path):
+    gem_keys = [("amber", "1.0.0", "ruby"), ("panda", "0.1.0", "java")]
+    write_specs(gem_keys, tmp_path / "specs", gzip_level=1)
+    assert (
+        gzip.decompress((tmp_path / "specs.gz").read_bytes()) == (tmp_path / "specs").read_bytes()
+    )
+    first = (tmp_path / "specs.gz").read_bytes()
+    write_specs(gem_keys, tmp_path / "specs", gzip_level=1)
+    assert (tmp_path / "specs.gz").read_bytes() == first
+    assert first[4:8] == b"\x00\x00\x00\x00"
+
+
+GEM_METADATA = """--- !ruby/object:Gem::Specification
+name: amber
+version: !ruby/object:Gem::Version
+  version: 1.0.0
+platform: ruby
+authors:
+- Pulp
+date: 2024-01-01 00:00:00.000000000 Z
+dependencies:
+- !ruby/object:Gem::Dependency
+  name: panda
+  requirement: !ruby/object:Gem::Requirement
+    requirements:
+    - - ">="
+      - !ruby/object:Gem::Version
+        version: '1'
+  type: :runtime
+  prerelease: false
+  version_requirements: !ruby/object:Gem::Requirement
+    requirements:
+    - - ">="
+      - !ruby/object:Gem::Version
+        version: '1'
+required_ruby_version: !ruby/object:Gem::Requirement
+  requirements:
+  - - ">="
+    - !ruby/object:Gem::Version
+      version: '2.7'
+required_rubygems_version: !ruby/object:Gem::Requirement
+  requirements:
+  - - ">="
+    - !ruby/object:Gem::Version
+      version: '0'
+rubygems_version: 3.5.3
+specification_version: 4
+summary: A test gem.
+"""
+
+
+def _build_gem(path, data_size):
+    with tarfile.open(path, "w") as archive:
+        for name, data in (
+            ("metadata.gz", gzip.compress(GEM_METADATA.encode())),
+            ("data.tar.gz", os.urandom(data_size)),
+        ):
+            member = tarfile.TarInfo(name)
+            member.size = len(data)
+            archive.addfile(member, io.BytesIO(data))
+
+
+class _ForwardOnlyReader:
+    """A file object that can only be read forward, counting the bytes read."""
+
+    def __init__(self, file_obj):
+        self.file_obj = file_obj
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.file_obj.read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+def test_analyse_gem_reads_metadata_only(tmp_path):
+    path = tmp_path / "amber-1.0.0.gem"
+    _build_gem(path, data_size=1024 * 1024)
+    with open(path, "rb") as gem_file:
+        reader = _ForwardOnlyReader(gem_file)
+        gem_info, spec_data = analyse_gem(reader)
+    assert reader.bytes_read < 64 * 1024
+    assert gem_info == {
+        "name": "amber",
+        "version": "1.0.0",
+        "version_key": ruby_ver_db_key("1.0.0"),
+        "platform": "ruby",
+        "prerelease": False,
+        "required_ruby_version": ">= 2.7",
+        "required_rubygems_version": ">= 0",
+        "dependencies": {"panda": ">= 1"},
+    }
+    spec = rubymarshal.reader.loads(zlib.decompress(spec_data))
+    assert spec._private_data["name"] == "amber"
+
+
+def test_analyse_gem_without_metadata(tmp_path):
+    path = tmp_path / "broken.gem"
+    with tarfile.open(path, "w"):
+        pass
+    with open(path, "rb") as gem_file, pytest.raises(KeyError):
+        analyse_gem(gem_file)
+
+
+YAML_PARITY_CORPUS = [
+    GEM_METADATA,
+    GEM_METADATA.replace("platform: ruby", "platform: java").replace(
+        "version: 1.0.0", "version: 1.0.0.rc1"
+    ),
+    GEM_METADATA
+    + """description: |
+  A multi-line description
+  with unicode: ü ✓
+email:
+- pulp@example.com
+homepage: https://example.com/amber
+licenses:
+- GPL-2.0-or-later
+metadata:
+  source_code_uri: https://example.com/amber.git
+  rubygems_mfa_required: 'true'
+""",
+    GEM_METADATA.replace(
+        "date: 2024-01-01 00:00:00.000000000 Z", "date: 2011-05-07 12:34:56.123456000 Z"
+    ).replace("dependencies:\n", "rubyforge_project: amber\nhas_rdoc: false\ndependencies:\n"),
+    GEM_METADATA[: GEM_METADATA.index("dependencies:")]
+    + "dependencies: []\n"
+    + GEM_METADATA[GEM_METADATA.index("required_ruby_version:") :],
+]
+
+
+@pytest.mark.skipif(CRubyMarshalYamlLoader is None, reason="LibYAML is not available.")
+@pytest.mark.parametrize("document", YAML_PARITY_CORPUS)
+def test_yaml_loader_parity(document):
+    assert rubymarshal.writer.writes(
+        yaml.load(document, Loader=CRubyMarshalYamlLoader)
+    ) == rubymarshal.writer.writes(yaml.load(document, Loader=PyRubyMarshalYamlLoader))
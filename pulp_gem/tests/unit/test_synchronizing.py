@@ -0,0 +1,409 @@
+import asyncio
+import hashlib
+import uuid
+from collections import deque
+from unittest import mock
+from urllib.parse import urljoin
+
+import pytest
+from aiohttp import ClientResponseError
+from asgiref.sync import async_to_sync
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from pulpcore.plugin.download import DownloadResult
+from pulpcore.plugin.models import Artifact, Remote
+from pulpcore.plugin.stages import (
+    ArtifactSaver,
+    ContentSaver,
+    DeclarativeArtifact,
+    DeclarativeContent,
+    QueryExistingContents,
+)
+
+from pulp_gem.app.models import GemContent, GemInfoChecksum, GemRemote, GemRepository
+from pulp_gem.app.tasks import synchronizing
+from pulp_gem.app.tasks.synchronizing import (
+    GemDeclarativeVersion,
+    GemFirstStage,
+    GemspecGenerator,
+    synchronize,
+)
+from pulp_gem.specs import ruby_ver_db_key
+
+REMOTE_URL = "https://example.com/"
+VERSIONS_URL = urljoin(REMOTE_URL, "versions")
+VERSIONS = b"created_at: 2024-01-01T00:00:00Z\n---\namber 1.0.0 a1\npanda 0.1.0 p1\n"
+TAIL = b"panda 0.1.0 p1\n"
+RANGE_START = len(VERSIONS) - len(TAIL)
+VERSIONS_FILE = {
+    "size": len(VERSIONS),
+    "etag": '"v1"',
+    "last_modified": None,
+    "tail": TAIL.decode(),
+}
+
+
+class _StubServer:
+    """Answer the downloads of a remote with canned responses, recording the requests."""
+
+    def __init__(self, path, responses):
+        self.path = path
+        # (status, body, headers) tuples by url, in the order of the requests.
+        self.responses = {url: deque(url_responses) for url, url_responses in responses.items()}
+        self.requests = []
+
+    def get_downloader(self, url, **kwargs):
+        return _StubDownloader(self, url)
+
+
+class _StubDownloader:
+    def __init__(self, server, url):
+        self.server = server
+        self.url = url
+
+    async def run(self, extra_data=None):
+        headers = (extra_data or {}).get("request_kwargs", {}).get("headers", {})
+        self.server.requests.append((self.url, headers))
+        status, body, response_headers = self.server.responses[self.url].popleft()
+        if status >= 400:
+            raise ClientResponseError(None, (), status=status)
+        path = self.server.path / f"download-{len(self.server.requests)}"
+        path.write_bytes(body)
+        return DownloadResult(
+            url=self.url, artifact_attributes={}, path=str(path), headers=response_headers
+        )
+
+
+def _download_versions(tmp_path, responses, versions_file=VERSIONS_FILE):
+    server = _StubServer(tmp_path, {VERSIONS_URL: responses})
+    remote = mock.Mock(url=REMOTE_URL, get_downloader=server.get_downloader)
+    first_stage = GemFirstStage(remote, versions_file=versions_file)
+    path, offset = asyncio.run(first_stage._download_versions())
+    return first_stage, server.requests, path, offset
+
+
+def _range_headers(etag='"v1"'):
+    return {"Range": f"bytes={RANGE_START}-", "Accept-Encoding": "identity", "If-None-Match": etag}
+
+
+def _read(path):
+    with open(path, "rb") as fp:
+        return fp.read()
+
+
+class _StubProgressReport:
+    def __init__(self, **kwargs):
+        self.done = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def aincrement(self):
+        self.done += 1
+
+
+def _run_first_stage(first_stage):
+    """Run the first stage on its downloaded versions file, returning the emitted content."""
+    out_q = asyncio.Queue()
+    first_stage._connect(None, out_q)
+    with mock.patch.object(synchronizing, "ProgressReport", _StubProgressReport):
+        # Keep the database queries in this thread, within the transaction of the test.
+        async_to_sync(first_stage.run)()
+    return [out_q.get_nowait() for _ in range(out_q.qsize())]
+
+
+def _gem(name, version):
+    return GemContent.objects.create(
+        name=name,
+        version=version,
+        version_key=ruby_ver_db_key(version),
+        platform="ruby",
+        checksum=hashlib.sha256(f"{name}-{version}-{uuid.uuid4()}".encode()).hexdigest(),
+    )
+
+
+def _new_version(repository, add):
+    with repository.new_version() as repository_version:
+        repository_version.add_content(GemContent.objects.filter(pk__in=[c.pk for c in add]))
+    return repository_version
+
+
+def _save_content(dcs):
+    """Run the content through ContentSaver, returning the number of queries it made."""
+    in_q, out_q = asyncio.Queue(), asyncio.Queue()
+    for dc in dcs:
+        in_q.put_nowait(dc)
+    in_q.put_nowait(None)
+    content_saver = ContentSaver()
+    content_saver._connect(in_q, out_q)
+    with CaptureQueriesContext(connection) as queries:
+        async_to_sync(content_saver)()
+    return len(queries)
+
+
+def _carried_over(tmp_path, count, incremental=False):
+    """
+    Run a mirror sync of `count` unchanged gems, returning the content it emits.
+
+    An incremental sync only reads the last line of the versions file fetched before.
+    """
+    gems = [_gem(f"gem-{i}", "1.0.0") for i in range(count)]
+    repository = GemRepository.objects.create(name=f"repo-{uuid.uuid4().hex[:8]}")
+    base_version = _new_version(repository, gems)
+    known_info_checksums = {gem.name: f"m{i}" for i, gem in enumerate(gems)}
+    remote = GemRemote(url=REMOTE_URL, policy=Remote.ON_DEMAND)
+    first_stage = GemFirstStage(
+        remote, known_info_checksums=known_info_checksums, base_version=base_version
+    )
+    lines = [f"{name} 1.0.0 {md5}\n" for name, md5 in known_info_checksums.items()]
+    versions_path = tmp_path / f"versions-{count}"
+    if incremental:
+        versions_path.write_text(lines[-1])
+        first_stage.versions_offset = len(lines[-1])
+    else:
+        versions_path.write_text("".join(["created_at: 2024-01-01T00:00:00Z\n", "---\n"] + lines))
+    first_stage.versions_path = str(versions_path)
+    dcs = _run_first_stage(first_stage)
+    assert sorted(dc.content.pk for dc in dcs) == sorted(gem.pk for gem in gems)
+    return dcs
+
+
+def _info_file(*gems):
+    return "".join(["---\n"] + [f"{gem.version} |checksum:{gem.checksum}\n" for gem in gems])
+
+
+@pytest.mark.django_db
+def test_gemspec_generator_position():
+    remote = GemRemote(url="https://example.com/", policy=Remote.IMMEDIATE, generate_gemspecs=True)
+    stages = GemDeclarativeVersion(GemFirstStage(remote), None).pipeline_stages(None)
+    stage_types = [type(stage) for stage in stages]
+    index = stage_types.index(GemspecGenerator)
+    assert stage_types.index(ArtifactSaver) < stage_types.index(QueryExistingContents) < index
+    assert index < stage_types.index(ContentSaver)
+
+
+@pytest.mark.django_db
+def test_gemspec_generator_skips_existing_content():
+    remote = GemRemote(url="https://example.com/", policy=Remote.IMMEDIATE, generate_gemspecs=True)
+    content = GemContent(name="amber", version="1.0.0", platform="ruby")
+    content._state.adding = False
+    artifact = Artifact()
+    artifact._state.adding = False
+    d_artifact = DeclarativeArtifact(
+        artifact=artifact,
+        url="https://example.com/gems/amber-1.0.0.gem",
+        relative_path="gems/amber-1.0.0.gem",
+        remote=remote,
+    )
+    dc = DeclarativeContent(content=content, d_artifacts=[d_artifact])
+    GemspecGenerator()._add_gemspecs([dc])
+    assert dc.d_artifacts == [d_artifact]
+
+
+def test_download_versions_first_sync(tmp_path):
+    first_stage, requests, path, offset = _download_versions(
+        tmp_path, [(200, VERSIONS, {"ETag": '"v1"'})], versions_file=None
+    )
+    assert requests == [(VERSIONS_URL, {})]
+    assert (_read(path), offset) == (VERSIONS, 0)
+    assert first_stage.versions_file == VERSIONS_FILE
+
+
+def test_download_versions_not_modified(tmp_path):
+    first_stage, requests, path, offset = _download_versions(tmp_path, [(304, b"", {})])
+    assert requests == [(VERSIONS_URL, _range_headers())]
+    assert (path, offset) == (None, 0)
+    assert first_stage.versions_file == VERSIONS_FILE
+
+
+def test_download_versions_appended(tmp_path):
+    appended = b"amber -1.0.0 a2\n"
+    size = len(VERSIONS) + len(appended)
+    headers = {"Content-Range": f"bytes {RANGE_START}-{size - 1}/{size}", "ETag": '"v2"'}
+    first_stage, requests, path, offset = _download_versions(
+        tmp_path, [(206, TAIL + appended, headers)]
+    )
+    assert requests == [(VERSIONS_URL, _range_headers())]
+    # The unseen lines start after the overlap with the last sync.
+    assert _read(path)[offset:] == appended
+    assert first_stage.versions_file == {
+        "size": size,
+        "etag": '"v2"',
+        "last_modified": None,
+        "tail": appended.decode(),
+    }
+
+
+def test_download_versions_nothing_appended(tmp_path):
+    headers = {"Content-Range": f"bytes {RANGE_START}-{len(VERSIONS) - 1}/{len(VERSIONS)}"}
+    first_stage, requests, path, offset = _download_versions(tmp_path, [(206, TAIL, headers)])
+    assert requests == [(VERSIONS_URL, _range_headers())]
+    assert (path, offset) == (None, 0)
+
+
+def test_download_versions_range_ignored(tmp_path):
+    new_versions = VERSIONS + b"zebra 2.0 z1\n"
+    first_stage, requests, path, offset = _download_versions(
+        tmp_path, [(200, new_versions, {"ETag": '"v2"'})]
+    )
+    assert requests == [(VERSIONS_URL, _range_headers())]
+    assert (_read(path), offset) == (new_versions, 0)
+    assert first_stage.versions_file["size"] == len(new_versions)
+    assert first_stage.versions_file["tail"] == "zebra 2.0 z1\n"
+
+
+@pytest.mark.parametrize(
+    "range_response",
+    [
+        pytest.param((416, b"", {}), id="shorter"),
+        pytest.param(
+            (206, b"zebra 2.0 z1\n", {"Content-Range": f"bytes {RANGE_START}-/*"}),
+            id="overlap-mismatch",
+        ),
+    ],
+)
+def test_download_versions_rewritten(tmp_path, range_response):
+    new_versions = b"created_at: 2024-02-01T00:00:00Z\n---\nzebra 2.0 z1\n"
+    first_stage, requests, path, offset = _download_versions(
+        tmp_path, [range_response, (200, new_versions, {})]
+    )
+    # The whole file is fetched again, without the validators of the last sync.
+    assert requests == [(VERSIONS_URL, _range_headers()), (VERSIONS_URL, {})]
+    assert (_read(path), offset) == (new_versions, 0)
+    assert first_stage.versions_file["size"] == len(new_versions)
+
+
+@pytest.mark.django_db
+def test_synchronize_unchanged_versions():
+    remote = GemRemote.objects.create(name=f"remote-{uuid.uuid4().hex[:8]}", url=REMOTE_URL)
+    repository = GemRepository.objects.create(name=f"repo-{uuid.uuid4().hex[:8]}")
+    with (
+        mock.patch.object(
+            GemFirstStage, "download_versions", mock.AsyncMock(return_value=False)
+        ) as download_versions,
+        mock.patch.object(synchronizing, "GemDeclarativeVersion") as declarative_version,
+    ):
+        synchronize(remote.pk, repository.pk)
+    download_versions.assert_awaited_once()
+    declarative_version.assert_not_called()
+    repository.refresh_from_db()
+    assert repository.latest_version().number == 0
+    assert repository.last_sync_details == {}
+
+
+@pytest.mark.django_db
+def test_first_stage_drops_yanked_versions(tmp_path):
+    amber_1 = _gem("amber", "1.0.0")
+    amber_2 = _gem("amber", "1.1.0")
+    panda = _gem("panda", "0.1.0")
+    repository = GemRepository.objects.create(name=f"repo-{uuid.uuid4().hex[:8]}")
+    base_version = _new_version(repository, [amber_1, amber_2, panda])
+    server = _StubServer(
+        tmp_path, {urljoin(REMOTE_URL, "info/amber"): [(200, _info_file(amber_1).encode(), {})]}
+    )
+    remote = GemRemote(url=REMOTE_URL, policy=Remote.ON_DEMAND)
+    remote.get_downloader = server.get_downloader
+    # A mirror sync after an appended line yanked a version.
+    first_stage = GemFirstStage(
+        remote, known_info_checksums={"amber": "a1", "panda": "p1"}, base_version=base_version
+    )
+    versions_path = tmp_path / "versions"
+    versions_path.write_bytes(TAIL + b"amber -1.1.0 a2\n")
+    first_stage.versions_path, first_stage.versions_offset = str(versions_path), len(TAIL)
+
+    dcs = _run_first_stage(first_stage)
+    assert [url for url, _headers in server.requests] == [urljoin(REMOTE_URL, "info/amber")]
+    assert sorted((dc.content.name, dc.content.version) for dc in dcs) == [
+        ("amber", "1.0.0"),
+        ("panda", "0.1.0"),
+    ]
+    # Only the unchanged gem is carried over, the yanked version is dropped by the mirror sync.
+    assert [dc.content.pk for dc in dcs if not dc.content._state.adding] == [panda.pk]
+    assert first_stage.info_checksums == {"amber": "a2", "panda": "p1"}
+    # Saved, the content resolves to the existing units, all but the yanked one.
+    _save_content(dcs)
+    assert sorted(dc.content.pk for dc in dcs) == sorted([amber_1.pk, panda.pk])
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("change", [None, "remote", "version", "mirror"])
+def test_synchronize_trusts_recorded_checksums(change):
+    remote = GemRemote.objects.create(name=f"remote-{uuid.uuid4().hex[:8]}", url=REMOTE_URL)
+    repository = GemRepository.objects.create(name=f"repo-{uuid.uuid4().hex[:8]}")
+    base_version = _new_version(repository, [_gem("amber", "1.0.0")])
+    repository.last_sync_details = {
+        "params": {
+            "remote": str(remote.pk),
+            "remote_last_updated": str(remote.pulp_last_updated),
+            "mirror": False,
+        },
+        "version": base_version.number,
+        "versions_file": VERSIONS_FILE,
+    }
+    repository.save()
+    GemInfoChecksum.objects.create(repository=repository, name="amber", md5="a1")
+
+    if change == "remote":
+        remote.url = urljoin(REMOTE_URL, "other/")
+        remote.save()
+    elif change == "version":
+        base_version = _new_version(repository, [_gem("panda", "0.1.0")])
+    with mock.patch.object(synchronizing, "GemFirstStage") as first_stage_class:
+        first_stage_class.return_value.download_versions = mock.AsyncMock(return_value=False)
+        synchronize(remote.pk, repository.pk, mirror=change == "mirror")
+
+    kwargs = first_stage_class.call_args.kwargs
+    assert kwargs["base_version"] == (base_version if change == "mirror" else None)
+    if change is None:
+        assert kwargs["known_info_checksums"] == {"amber": "a1"}
+        assert kwargs["versions_file"] == VERSIONS_FILE
+        assert GemInfoChecksum.objects.filter(repository=repository).exists()
+    else:
+        # The latest version may not match the recorded state, so it is not used.
+        assert kwargs["known_info_checksums"] == {}
+        assert kwargs["versions_file"] is None
+        assert not GemInfoChecksum.objects.filter(repository=repository).exists()
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("mirror", [True, False])
+def test_first_stage_carries_over_unchanged_gems(tmp_path, mirror):
+    amber = _gem("amber", "1.0.0")
+    panda = _gem("panda", "0.1.0")
+    repository = GemRepository.objects.create(name=f"repo-{uuid.uuid4().hex[:8]}")
+    base_version = _new_version(repository, [amber, panda])
+    server = _StubServer(
+        tmp_path, {urljoin(REMOTE_URL, "info/amber"): [(200, _info_file(amber).encode(), {})]}
+    )
+    remote = GemRemote(url=REMOTE_URL, policy=Remote.ON_DEMAND)
+    remote.get_downloader = server.get_downloader
+    # Only the info file of amber changed since the last sync.
+    first_stage = GemFirstStage(
+        remote,
+        known_info_checksums={"amber": "a0", "panda": "p1"},
+        base_version=base_version if mirror else None,
+    )
+    versions_path = tmp_path / "versions"
+    versions_path.write_bytes(VERSIONS)
+    first_stage.versions_path = str(versions_path)
+
+    dcs = _run_first_stage(first_stage)
+    assert [url for url, _headers in server.requests] == [urljoin(REMOTE_URL, "info/amber")]
+    assert [dc.content.name for dc in dcs if dc.content._state.adding] == ["amber"]
+    # A mirror sync keeps the unchanged gems by carrying them over from the base version.
+    carried_over = [dc.content.pk for dc in dcs if not dc.content._state.adding]
+    assert carried_over == ([panda.pk] if mirror else [])
+    assert first_stage.info_checksums == {"amber": "a1", "panda": "p1"}
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("incremental", [False, True])
+def test_carried_over_content_is_saved_in_constant_queries(tmp_path, incremental):
+    # Reading a field left out of the carried over content would cost a query per gem.
+    assert _save_content(_carried_over(tmp_path, 1, incremental)) == _save_content(
+        _carried_over(tmp_path, 20, incremental)
+    )